@@ -0,0 +1,275 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+
+import os
+import argparse
+import sys
+import json
+import base64
+import binascii
+import random
+import shutil
+import platform
+import subprocess
+import tempfile
+from timeit import default_timer
+from fb2rename import *
+
+
+class Corpus(object):
+    encodings = ['utf-8', 'windows-1251']
+    latin = [u'Ar', u'Bo', u'Cel', u'Dan', u'Ed', u'For', u'Gus', u'Hal']
+    cyrillic = [u'Ан', u'Бо', u'Вел', u'Гри', u'Дан', u'Ев', u'Жу', u'Зо']
+    files_per_dir = 1000
+
+    def __init__(self, a_seed=0, a_max_authors=4, a_max_sequences=2,
+                 a_max_header_kb=4, a_max_body_kb=64, a_max_binary_kb=64):
+        self.seed = a_seed
+        self.max_authors = a_max_authors
+        self.max_sequences = a_max_sequences
+        self.max_header_kb = a_max_header_kb
+        self.max_body_kb = a_max_body_kb
+        self.max_binary_kb = a_max_binary_kb
+
+    def get_params(self):
+        return dict((k, v) for k, v in self.__dict__.items())
+
+    @staticmethod
+    def word(a_rng, a_syllables, a_count=2):
+        return u''.join(a_rng.choice(a_syllables) for i in range(a_count))
+
+    def generate(self, a_index):
+        rng = random.Random('%d-%d' % (self.seed, a_index))
+        encoding = self.encodings[a_index % len(self.encodings)]
+        syllables = self.latin
+        if encoding != 'utf-8':
+            syllables = self.cyrillic
+        parts = []
+        for i in range(rng.randint(1, self.max_authors)):
+            parts.append(
+                u'<author><first-name>%s</first-name>'
+                u'<middle-name>%s</middle-name>'
+                u'<last-name>%s</last-name></author>' % (
+                    self.word(rng, syllables), self.word(rng, syllables),
+                    self.word(rng, syllables, 3)))
+        parts.append(u'<book-title>%s %d</book-title>' % (
+            self.word(rng, syllables, 4), a_index))
+        parts.append(u'<date value="%04d-%02d-%02d">%04d</date>' % (
+            rng.randint(1900, 2020), rng.randint(1, 12), rng.randint(1, 28),
+            rng.randint(1900, 2020)))
+        for i in range(rng.randint(0, self.max_sequences)):
+            parts.append(u'<sequence name="%s" number="%d"/>' % (
+                self.word(rng, syllables, 3), rng.randint(1, 30)))
+        annotation = self.text(rng, syllables, self.max_header_kb)
+        body = self.text(rng, syllables, self.max_body_kb)
+        binary = ''
+        size = rng.randint(0, self.max_binary_kb) * 1024
+        if size:
+            data = binascii.unhexlify(
+                '%0*x' % (size * 2, rng.getrandbits(size * 8)))
+            binary = u'<binary id="cover.jpg" content-type="image/jpeg">' + \
+                base64.b64encode(data).decode('ascii') + u'</binary>'
+        content = (
+            u'<?xml version="1.0" encoding="%s"?>\n'
+            u'<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" '
+            u'xmlns:l="http://www.w3.org/1999/xlink">'
+            u'<description><title-info><genre>sf</genre>%s'
+            u'<annotation>%s</annotation><lang>ru</lang></title-info>'
+            u'<document-info><id>%s-%d</id></document-info></description>'
+            u'<body>%s</body>%s</FictionBook>' % (
+                encoding, u''.join(parts), annotation, self.seed, a_index,
+                body, binary))
+        return content.encode(encoding)
+
+    def text(self, a_rng, a_syllables, a_max_kb):
+        size = a_rng.randint(0, a_max_kb * 1024)
+        paragraphs = []
+        length = 0
+        while length < size:
+            paragraph = u' '.join(
+                self.word(a_rng, a_syllables, a_rng.randint(1, 4))
+                for i in range(40))
+            paragraphs.append(u'<p>' + paragraph + u'</p>')
+            length += len(paragraph)
+        return u''.join(paragraphs)
+
+    def get_path(self, a_dir, a_index):
+        return os.path.join(
+            a_dir, '%04d' % (a_index // self.files_per_dir),
+            'book%07d.fb2' % a_index)
+
+    def write(self, a_dir, a_count):
+        marker = os.path.join(a_dir, 'corpus.json')
+        params = self.get_params()
+        params['count'] = a_count
+        if os.path.exists(marker):
+            with open(marker) as f:
+                if json.load(f) == params:
+                    return
+            shutil.rmtree(a_dir)
+        for i in range(a_count):
+            path = self.get_path(a_dir, i)
+            Common.ensure_path_exists(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(self.generate(i))
+        with open(marker, 'w') as f:
+            json.dump(params, f)
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, a_stage, a_seconds, a_count=1):
+        self.seconds[a_stage] = self.seconds.get(a_stage, 0.0) + a_seconds
+        self.counts[a_stage] = self.counts.get(a_stage, 0) + a_count
+
+    def get_results(self):
+        results = {}
+        for stage, seconds in self.seconds.items():
+            count = self.counts[stage]
+            results[stage] = {
+                'seconds': round(seconds, 6),
+                'files': count,
+                'files_per_second': round(count / seconds, 1) if seconds else None
+            }
+        return results
+
+
+def get_commit():
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT)
+        return out.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(a_corpus_dir, a_out_dir, a_template):
+    timer = StageTimer()
+    template = NameTemplate(a_template)
+
+    start = default_timer()
+    files = get_files_to_work_with([], ['fb2'], [a_corpus_dir], True)
+    timer.add('discovery', default_timer() - start, len(files))
+
+    book = Book_fb2()
+    names = []
+    for fname in files:
+        start = default_timer()
+        book.open(fname, template.fields, template.fallbacks)
+        parsed = default_timer()
+        try:
+            name = format_name(book, template)
+            name = Common.validate_filename(name + '.fb2')
+        except Exception:
+            name = None
+        timer.add('parsing', parsed - start)
+        timer.add('formatting', default_timer() - parsed)
+        names.append(name)
+
+    moved = []
+    start = default_timer()
+    for fname, name in zip(files, names):
+        if not name:
+            continue
+        target = os.path.join(a_out_dir, '%07d %s' % (len(moved), name))
+        FileOps.apply('move', fname, target)
+        moved.append((fname, target))
+    timer.add('renaming', default_timer() - start, len(moved))
+    for fname, target in moved:
+        os.rename(target, fname)
+    return timer.get_results()
+
+
+def compare(a_old, a_new):
+    for size in sorted(set(a_old) & set(a_new), key=int):
+        old_stages = a_old[size]['stages']
+        new_stages = a_new[size]['stages']
+        for stage in sorted(set(old_stages) & set(new_stages)):
+            old = old_stages[stage]['seconds']
+            new = new_stages[stage]['seconds']
+            ratio = new / old if old else float('nan')
+            print '%8s %-12s %10.3fs %10.3fs %7.2fx' % (
+                size, stage, old, new, ratio)
+
+
+def load_results(a_path):
+    results = {}
+    with open(a_path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[str(result['files'])] = result
+    return results
+
+
+def manage_cmd():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks fb2rename stages on a synthetic corpus.')
+    parser.add_argument(
+        '--sizes', dest='sizes', action='store', default='1000',
+        help='Comma separated corpus sizes, e.g. 1000,100000,1000000.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, action='store', default=0,
+        help='Seed of the corpus generator.')
+    parser.add_argument(
+        '--corpus', dest='corpus', action='store', default='',
+        help='Directory to keep generated corpora between runs.')
+    parser.add_argument(
+        '--body-kb', dest='body_kb', type=int, action='store', default=64,
+        help='Maximum body size of a generated book in KB.')
+    parser.add_argument(
+        '--binary-kb', dest='binary_kb', type=int, action='store', default=64,
+        help='Maximum embedded binary size of a generated book in KB.')
+    parser.add_argument(
+        '--template', '-t', dest='template', action='store',
+        default=Common.get_templates()['default'],
+        help='Format used for the formatting stage.')
+    parser.add_argument(
+        '--output', dest='output', action='store', default='',
+        help='Append results as JSON lines to this file.')
+    parser.add_argument(
+        '--compare', dest='compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two result files instead of running.')
+    return parser.parse_args()
+
+
+def main():
+    args = manage_cmd()
+    if args.compare:
+        compare(load_results(args.compare[0]), load_results(args.compare[1]))
+        return
+    corpus = Corpus(
+        args.seed, a_max_body_kb=args.body_kb, a_max_binary_kb=args.binary_kb)
+    workdir = tempfile.mkdtemp(prefix='fb2rename_bench')
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            corpus_dir = os.path.join(
+                args.corpus or workdir, 'corpus_%d_%d' % (args.seed, size))
+            corpus.write(corpus_dir, size)
+            out_dir = os.path.join(workdir, 'out_%d' % size)
+            os.makedirs(out_dir)
+            result = {
+                'commit': get_commit(),
+                'python': platform.python_version(),
+                'files': size,
+                'corpus': corpus.get_params(),
+                'template': args.template,
+                'stages': run_benchmark(corpus_dir, out_dir, args.template)
+            }
+            line = json.dumps(result, sort_keys=True)
+            print line
+            if args.output:
+                with open(args.output, 'a') as f:
+                    f.write(line + '\n')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,133 @@ import os
 import argparse
 import sys
 import re
-from time import strftime, strptime
+import select
+import shutil
+import array
+import collections
+import contextlib
+import csv
+import ctypes
+import ctypes.util
+import errno
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
+import sqlite3
+import stat
+import struct
+import time
+import zipfile
+from timeit import default_timer
 from lxml import etree
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class Sanitizer(object):
+    common = {
+        u'№': u'n', u'"': u"'", u'\u00BB': u"'", u'\u00AB': u"'",
+        u'…': u'_', u'–': u'-'
+    }
+    tag = {u'\\': u'.', u'/': u'.'}
+    filesystems = {
+        'default': {u'?': u'.', u':': u'.'},
+        'ext4': {},
+        'ntfs': {
+            u'?': u'.', u':': u'.', u'<': u'_', u'>': u'_', u'|': u'_',
+            u'*': u'_'
+        },
+        'fat': {
+            u'?': u'.', u':': u'.', u'<': u'_', u'>': u'_', u'|': u'_',
+            u'*': u'_', u'+': u'_', u',': u'_', u';': u'_', u'=': u'_',
+            u'[': u'(', u']': u')'
+        }
+    }
+    reserved = set(
+        ['con', 'prn', 'aux', 'nul'] +
+        ['com%d' % i for i in range(1, 10)] +
+        ['lpt%d' % i for i in range(1, 10)])
+    translit = dict(zip(
+        u'абвгдеёжзийклмнопрстуфхцчшщъыьэюя',
+        [u'a', u'b', u'v', u'g', u'd', u'e', u'e', u'zh', u'z', u'i', u'y',
+         u'k', u'l', u'm', u'n', u'o', u'p', u'r', u's', u't', u'u', u'f',
+         u'kh', u'ts', u'ch', u'sh', u'shch', u'', u'y', u'', u'e', u'yu',
+         u'ya']))
+
+    def __init__(self, a_filesystem='default', a_translit=False,
+                 a_max_bytes=255):
+        if a_filesystem not in self.filesystems:
+            raise Exception('No such filesystem: ' + a_filesystem)
+        self.filesystem = a_filesystem
+        self.max_bytes = a_max_bytes
+        self.windows = a_filesystem in ('ntfs', 'fat')
+        common = dict(self.common)
+        for ch in range(32):
+            common[unichr(ch)] = u' '
+        if a_translit:
+            for ch, latin in self.translit.items():
+                common[ch] = latin
+                common[ch.upper()] = latin.capitalize()
+        self.common_table = self.compile(common)
+        self.tag_table = self.compile(common, self.tag)
+        self.name_table = self.compile(common, self.filesystems[a_filesystem])
+
+    @staticmethod
+    def compile(*a_rules):
+        table = {}
+        for rules in a_rules:
+            for ch, replacement in rules.items():
+                table[ord(ch)] = replacement
+        return table
+
+    @staticmethod
+    def clean(a_str, a_table):
+        if isinstance(a_str, str):
+            a_str = a_str.decode('utf-8', 'replace')
+        return u' '.join(a_str.translate(a_table).split())
+
+    def validate_tag(self, a_tag):
+        return self.clean(a_tag, self.tag_table)
+
+    def validate_component(self, a_name):
+        name = self.clean(a_name, self.name_table)
+        if self.windows:
+            name = name.rstrip(u'. ')
+            if name.split(u'.')[0].lower() in self.reserved:
+                name = u'_' + name
+        return self.truncate(name)
+
+    def truncate(self, a_name):
+        base, ext = Common.split_extension(a_name)
+        return Common.truncate_name(base, ext, self.max_bytes)
+
+    def validate_filename(self, a_path):
+        if isinstance(a_path, str):
+            a_path = a_path.decode('utf-8', 'replace')
+        components = a_path.replace(u'\\', u'/').split(u'/')
+        components = [self.validate_component(c) for c in components]
+        return os.sep.join(
+            c for c in components if c and c not in (u'.', u'..'))
 
 
 class Common(object):
     replace_single_quote = ['"', u"\u00BB", u"\u00AB"]
     replace_underscore = [u'…']
     replace_dash = [u"–"]
+    sanitizer = Sanitizer()
 
     @staticmethod
     def ensure_path_exists(path):
@@ -32,25 +151,45 @@ class Common(object):
 
     @staticmethod
     def validate_common(a_str):
-        result = a_str.strip()
-        result = Common.replace(result, [u'№'], 'n')
-        result = Common.replace(result, Common.replace_single_quote, "'")
-        result = Common.replace(result, Common.replace_underscore, "_")
-        result = Common.replace(result, Common.replace_dash, "-")
-        result = ' '.join(result.split())
-        return result
+        return Sanitizer.clean(a_str, Common.sanitizer.common_table)
 
     @staticmethod
     def validate_filename(a_filename):
-        result = Common.validate_common(a_filename)
-        result = Common.replace(result, ['?', ':'], '.')
-        return result
+        return Common.sanitizer.validate_filename(a_filename)
 
     @staticmethod
     def validate_tag(a_tag):
-        result = Common.validate_common(a_tag)
-        result = Common.replace(result, ['\\', '/'], '.')
-        return result
+        return Common.sanitizer.validate_tag(a_tag)
+
+    @staticmethod
+    def split_extension(a_name):
+        for ext in Book_fb2.extensions:
+            if a_name.endswith('.' + ext):
+                return a_name[:-len(ext) - 1], '.' + ext
+        return os.path.splitext(a_name)
+
+    @staticmethod
+    def truncate_name(a_base, a_tail, a_max_bytes):
+        name = a_base + a_tail
+        if a_max_bytes <= 0 or len(name.encode('utf-8')) <= a_max_bytes:
+            return name
+        size = a_max_bytes - len(a_tail.encode('utf-8'))
+        base = a_base.encode('utf-8')[:max(size, 0)].decode('utf-8', 'ignore')
+        return base.rstrip(u'. ') + a_tail
+
+    @staticmethod
+    def get_error_text(a_error):
+        try:
+            return unicode(a_error)
+        except UnicodeError:
+            return str(a_error).decode('utf-8', 'replace')
+
+    @staticmethod
+    def decode_path(a_path):
+        if isinstance(a_path, str):
+            return a_path.decode(
+                sys.getfilesystemencoding() or 'utf-8', 'replace')
+        return a_path
 
     @staticmethod
     def get_templates():
@@ -59,6 +198,8 @@ class Common(object):
         templates['flat']           = r'%authors% - %title%'
         templates['sequence']       = r'%seq_name%\%seq_number%. %title%'
         templates['sequence_flat']  = r'%seq_name% - %seq_number%. %title%'
+        templates['letter']         = r'%letter%\%authors% - %title%'
+        templates['hashed']         = r'%hash%\%authors% - %title%'
         templates['default']        = templates['flat']
         return templates
 
@@ -66,11 +207,20 @@ class Common(object):
     def get_format_patterns():
         return [
             'authors', 'title', 'date', 'sequence',
-            'seq_name', 'seq_number', 'genre', 'oldname', 'year'
+            'seq_name', 'seq_number', 'genre', 'oldname', 'year',
+            'letter', 'hash', 'bookname', 'publisher', 'isbn', 'lang',
+            'pub_year', 'pub_sequence', 'pub_seq_name', 'pub_seq_number'
             ]
 
 
 class XmlWrapper(object):
+    @staticmethod
+    def local_name(a_element):
+        tag = a_element.tag
+        if not isinstance(tag, basestring):
+            return None
+        return tag.rpartition('}')[2]
+
     @staticmethod
     def get_xmlns_tag_path(a_element, a_path):
         xmlns = a_element.nsmap[None]
@@ -127,6 +277,171 @@ class XmlWrapper(object):
         return tag.attrib
 
 
+class BookMeta(object):
+    __slots__ = (
+        'oldname', 'authors', 'genres', 'title', 'date', 'lang', 'src_lang',
+        'sequences', 'doc_authors', 'doc_date', 'doc_id', 'version',
+        'doc_publisher', 'bookname', 'publisher', 'city', 'year', 'isbn',
+        'pub_sequences'
+    )
+    list_slots = (
+        'authors', 'genres', 'sequences', 'doc_authors', 'pub_sequences'
+    )
+    field_slots = {
+        'oldname': [], 'authors': ['authors'], 'title': ['title'],
+        'date': ['date'], 'year': ['date'], 'genre': ['genres'],
+        'sequence': ['sequences'], 'seq_name': ['sequences'],
+        'seq_number': ['sequences'], 'letter': ['authors'],
+        'hash': ['authors', 'title'], 'pub_year': ['year'],
+        'pub_sequence': ['pub_sequences'], 'pub_seq_name': ['pub_sequences'],
+        'pub_seq_number': ['pub_sequences']
+    }
+    sequence_items = {'sequence': None, 'seq_name': 0, 'seq_number': 1}
+    fallbacks = {
+        'title': ['bookname'], 'year': ['pub_year'],
+        'sequence': ['pub_sequence'], 'seq_name': ['pub_seq_name'],
+        'seq_number': ['pub_seq_number']
+    }
+    name_re = re.compile(r'[A-Za-z_]*')
+    date_re = re.compile(r'\s*(\d{4})-(\d{2})-(\d{2})')
+    year_re = re.compile(r'\d{4}')
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        for slot in self.list_slots:
+            setattr(self, slot, [])
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, a_state):
+        self.__init__()
+        for slot, value in a_state.items():
+            if slot not in self.__slots__ or value is None:
+                continue
+            if slot in self.list_slots:
+                value = [tuple(v) if isinstance(v, list) else v for v in value]
+            setattr(self, slot, value)
+
+    @staticmethod
+    def get_slots(a_fields, a_fallbacks=None):
+        if a_fields is None:
+            return None
+        if a_fallbacks is None:
+            a_fallbacks = BookMeta.fallbacks
+        slots = set()
+        for field in a_fields:
+            for item in [field] + a_fallbacks.get(field, []):
+                slots.update(BookMeta.field_slots.get(item, [item]))
+        return slots
+
+    def find_authors(self, a_item):
+        author_format = a_item.replace('authors', '').strip()
+        if not author_format:
+            author_format = '#L, #F #M'
+        authors = []
+        for first, middle, last in self.authors:
+            if first or middle or last:
+                authors.append(Book.format_person_name(
+                    first, middle, last, author_format))
+        if not authors:
+            return None
+        return '; '.join(authors)
+
+    @staticmethod
+    def find_sequence(a_sequences, a_index=None):
+        if not a_sequences:
+            return None
+        sequence = a_sequences[0]
+        if a_index is None:
+            return '-'.join([v or '' for v in sequence])
+        return sequence[a_index]
+
+    def find_letter(self):
+        if not self.authors:
+            return None
+        first, middle, last = self.authors[0]
+        name = (last or first or middle or u'').strip()
+        if not name or not name[0].isalpha():
+            return u'#'
+        return name[0].upper()
+
+    def find_hash(self, a_item):
+        digits = a_item.replace('hash', '').strip()
+        digits = int(digits) if digits.isdigit() else 2
+        data = u'\n'.join(
+            [u' '.join(n or u'' for n in a) for a in self.authors] +
+            [self.title or u''])
+        return unicode(
+            hashlib.sha1(data.encode('utf-8')).hexdigest()[:digits])
+
+    @staticmethod
+    def find_year(a_value):
+        found = BookMeta.year_re.search(a_value or '')
+        if found is None:
+            return None
+        return found.group(0)
+
+    def find_value(self, a_item):
+        name = self.name_re.match(a_item).group(0)
+        if name == 'authors':
+            return self.find_authors(a_item)
+        if name in self.sequence_items:
+            return self.find_sequence(
+                self.sequences, self.sequence_items[name])
+        if name.startswith('pub_') and name[4:] in self.sequence_items:
+            return self.find_sequence(
+                self.pub_sequences, self.sequence_items[name[4:]])
+        if name == 'date':
+            found = self.date_re.match(self.date or '')
+            if found is None:
+                return None
+            return '-'.join(found.groups())
+        if name == 'year':
+            return self.find_year(self.date)
+        if name == 'pub_year':
+            return self.find_year(self.year)
+        if name == 'letter':
+            return self.find_letter()
+        if name == 'hash':
+            return self.find_hash(a_item)
+        if name == 'genre':
+            if self.genres:
+                return self.genres[0]
+            return None
+        if name in self.__slots__ and name not in self.list_slots:
+            return getattr(self, name)
+        return None
+
+    @staticmethod
+    def get_chain(a_item, a_fallbacks=None):
+        if a_fallbacks is None:
+            a_fallbacks = BookMeta.fallbacks
+        name = BookMeta.name_re.match(a_item).group(0)
+        return [a_item] + a_fallbacks.get(name, [])
+
+    @staticmethod
+    def get_fallbacks(a_values):
+        fallbacks = dict(BookMeta.fallbacks)
+        patterns = Common.get_format_patterns()
+        for value in a_values:
+            field, _, chain = value.partition('=')
+            chain = [c.strip() for c in chain.split(',') if c.strip()]
+            for item in [field] + chain:
+                if item not in patterns:
+                    raise Exception('Unknown field in fallback: ' + item)
+            fallbacks[field] = chain
+        return fallbacks
+
+    def get_value(self, a_item, a_fallbacks=None):
+        for item in self.get_chain(a_item, a_fallbacks):
+            value = self.find_value(item)
+            if value is not None and value.strip():
+                return Common.validate_tag(value)
+        raise Exception("There's no " + a_item)
+
+
 class Book(object):
 
     def __init__(self):
@@ -140,6 +455,8 @@ class Book(object):
         ]
         self.filepath = ''
         self.format = ''
+        self.extensions = []
+        self.meta = None
 
     @staticmethod
     def format_person_name(a_first, a_middle, a_last, a_format='#L, #F #M'):
@@ -160,24 +477,103 @@ class Book(object):
     def open_virtual(self, a_path):
         raise NotImplementedError('virtual function')
 
-    def open(self, a_path):
-        if not os.path.exists(a_path):
+    def extract_virtual(self, a_slots):
+        raise NotImplementedError('virtual function')
+
+    def exists(self, a_path):
+        return os.path.exists(a_path)
+
+    def get_size(self, a_path):
+        return os.path.getsize(a_path)
+
+    def open(self, a_path, a_fields=None, a_fallbacks=None):
+        self.meta = None
+        if not self.exists(a_path):
             return
         self.filepath = a_path
         self.open_virtual(a_path)
+        self.meta = self.extract_virtual(
+            BookMeta.get_slots(a_fields, a_fallbacks))
+        self.meta.oldname = self.get_oldname()
+
+    def load(self, a_path, a_meta):
+        self.filepath = a_path
+        self.meta = a_meta
+        self.meta.oldname = self.get_oldname()
 
-    def get_value_virtual(self, a_item):
+    def get_value_virtual(self, a_item, a_fallbacks=None):
         raise NotImplementedError('virtual function')
 
-    def get_value(self, a_item):
-        return self.get_value_virtual(a_item)
+    def get_value(self, a_item, a_fallbacks=None):
+        return self.get_value_virtual(a_item, a_fallbacks)
+
+    def get_extension(self, a_path=None):
+        if a_path is None:
+            a_path = self.filepath
+        for ext in self.extensions:
+            if a_path.endswith('.' + ext):
+                return '.' + ext
+        return os.path.splitext(a_path)[1]
 
     def get_oldname(self):
         if self.filepath:
-            return os.path.splitext(os.path.basename(self.filepath))[0]
+            name = os.path.basename(self.filepath)
+            return name[:len(name) - len(self.get_extension())]
         return ''
 
 
+class LimitError(Exception):
+    pass
+
+
+class LimitedStream(object):
+
+    def __init__(self, a_stream, a_max_bytes, a_deadline, a_what):
+        self.stream = a_stream
+        self.max_bytes = a_max_bytes
+        self.deadline = a_deadline
+        self.what = a_what
+        self.count = 0
+
+    def read(self, a_size=-1):
+        if self.deadline and default_timer() > self.deadline:
+            raise LimitError('Parsing took too long')
+        if self.max_bytes:
+            left = self.max_bytes - self.count
+            if left <= 0:
+                if self.stream.read(1):
+                    raise LimitError('%s is larger than %d bytes' % (
+                        self.what, self.max_bytes))
+                return ''
+            if a_size is None or a_size < 0 or a_size > left:
+                a_size = left
+        data = self.stream.read(a_size)
+        self.count += len(data)
+        return data
+
+
+class ParseLimits(object):
+
+    def __init__(self, a_max_bytes=0, a_max_header=0, a_max_time=0):
+        self.max_bytes = a_max_bytes
+        self.max_header = a_max_header
+        self.max_time = a_max_time
+
+    def get_deadline(self):
+        if not self.max_time:
+            return None
+        return default_timer() + self.max_time
+
+    def wrap(self, a_stream, a_deadline, a_header=False):
+        if a_header and self.max_header and \
+                not 0 < self.max_bytes < self.max_header:
+            return LimitedStream(
+                a_stream, self.max_header, a_deadline, 'Header')
+        if not self.max_bytes and not a_deadline:
+            return a_stream
+        return LimitedStream(a_stream, self.max_bytes, a_deadline, 'Book')
+
+
 class Book_fb2(Book):
     title_tags = {
         'genre': 'description/title-info/genre',
@@ -196,6 +592,7 @@ class Book_fb2(Book):
     document_tags = {
         'authors': 'description/document-info/author',
         'date': 'description/document-info/date',
+        'id': 'description/document-info/id',
         'version': 'description/document-info/version',
         'publisher': 'description/document-info/publisher'
     }
@@ -209,238 +606,2821 @@ class Book_fb2(Book):
         'sequence': 'description/publish-info/sequence'
     }
 
-    def __init__(self):
+    meta_slots = {
+        'title-info': {
+            'genre': 'genres', 'author': 'authors', 'book-title': 'title',
+            'date': 'date', 'lang': 'lang', 'src-lang': 'src_lang',
+            'sequence': 'sequences'
+        },
+        'document-info': {
+            'author': 'doc_authors', 'date': 'doc_date', 'id': 'doc_id',
+            'version': 'version', 'publisher': 'doc_publisher'
+        },
+        'publish-info': {
+            'book-name': 'bookname', 'bookname': 'bookname',
+            'publisher': 'publisher', 'city': 'city', 'year': 'year',
+            'isbn': 'isbn', 'sequence': 'pub_sequences'
+        }
+    }
+
+    extensions = ['fb2.zip', 'fb2.gz', 'fb2']
+    limits = ParseLimits()
+    parser_options = {
+        'resolve_entities': False, 'no_network': True, 'load_dtd': False,
+        'huge_tree': False
+    }
+    limit_messages = ['amplification', 'huge', 'excessive depth']
+
+    def __init__(self, a_header_only=True):
         super(Book_fb2, self).__init__()
         self.format = 'fb2'
+        self.extensions = Book_fb2.extensions
+        self.header_only = a_header_only
+        self.parse_error = None
 
     def open_virtual(self, a_path):
-        self.book = etree.parse(a_path).getroot()
-        self.xmlns = self.book.nsmap[None]
-        pass
+        self.book = None
+        self.parse_error = None
+        deadline = self.limits.get_deadline()
+        errors = []
+        if self.header_only:
+            try:
+                with self.open_book(a_path) as stream:
+                    self.book = self.read_header(
+                        self.limits.wrap(stream, deadline, True))
+            except etree.XMLSyntaxError as e:
+                if self.is_limit_error(e.code, e.msg):
+                    raise LimitError(e.msg)
+                errors.append(Common.get_error_text(e))
+                self.book = None
+        if self.book is None:
+            with self.open_book(a_path) as stream:
+                self.book = self.read_full(
+                    self.limits.wrap(stream, deadline), errors)
+            if self.book is None:
+                raise Exception("Can't parse " + a_path)
+        if errors:
+            self.parse_error = errors[0]
+        self.xmlns = self.book.nsmap.get(None)
+
+    @staticmethod
+    def is_limit_error(a_code, a_message):
+        if a_code == etree.ErrorTypes.ERR_ENTITY_LOOP:
+            return True
+        message = (a_message or '').lower()
+        return any(m in message for m in Book_fb2.limit_messages)
+
+    def open_book(self, a_path):
+        return Book_fb2.open_stream(a_path)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_stream(a_path):
+        if a_path.endswith('.zip'):
+            archive = zipfile.ZipFile(a_path)
+            try:
+                members = archive.infolist()
+                books = [m for m in members if m.filename.endswith('.fb2')]
+                if not books:
+                    books = members
+                if not books:
+                    raise Exception('There is no book in ' + a_path)
+                stream = archive.open(books[0])
+                try:
+                    yield stream
+                finally:
+                    stream.close()
+            finally:
+                archive.close()
+        elif a_path.endswith('.gz'):
+            stream = gzip.open(a_path, 'rb')
+            try:
+                yield stream
+            finally:
+                stream.close()
+        else:
+            with open(a_path, 'rb') as stream:
+                yield stream
+
+    @staticmethod
+    def read_header(a_stream):
+        root = None
+        context = etree.iterparse(
+            a_stream, events=('start', 'end'), **Book_fb2.parser_options)
+        for event, elem in context:
+            if root is None:
+                root = elem
+            if event == 'end' and \
+                    etree.QName(elem).localname == 'description':
+                for sibling in list(elem.itersiblings()):
+                    root.remove(sibling)
+                break
+        del context
+        return root
+
+    @staticmethod
+    def read_full(a_stream, a_errors=None):
+        parser = etree.XMLParser(recover=True, **Book_fb2.parser_options)
+        root = etree.parse(a_stream, parser).getroot()
+        for entry in parser.error_log:
+            if Book_fb2.is_limit_error(entry.type, entry.message):
+                raise LimitError(entry.message)
+            if a_errors is not None:
+                a_errors.append(entry.message)
+        return root
+
+    @staticmethod
+    def parse_header(a_path):
+        with Book_fb2.open_stream(a_path) as stream:
+            return Book_fb2.read_header(stream)
+
+    @staticmethod
+    def get_person(a_element):
+        names = {}
+        for elem in a_element:
+            names[XmlWrapper.local_name(elem)] = elem.text or ''
+        return (
+            names.get('first-name', ''), names.get('middle-name', ''),
+            names.get('last-name', ''))
 
     @staticmethod
-    def get_person_name(a_element, a_format):
+    def extract_meta(a_root, a_slots=None):
+        meta = BookMeta()
+        for description in a_root:
+            if XmlWrapper.local_name(description) == 'description':
+                break
+        else:
+            return meta
+        for section in description:
+            tags = Book_fb2.meta_slots.get(XmlWrapper.local_name(section))
+            if tags is None:
+                continue
+            for elem in section:
+                slot = tags.get(XmlWrapper.local_name(elem))
+                if slot is None or (a_slots is not None and slot not in a_slots):
+                    continue
+                if slot in ('authors', 'doc_authors'):
+                    value = Book_fb2.get_person(elem)
+                elif slot in ('sequences', 'pub_sequences'):
+                    value = (elem.get('name'), elem.get('number'))
+                elif slot == 'date':
+                    value = elem.get('value') or elem.text
+                else:
+                    value = elem.text
+                if slot in BookMeta.list_slots:
+                    getattr(meta, slot).append(value)
+                elif getattr(meta, slot) is None:
+                    setattr(meta, slot, value)
+        return meta
+
+    def extract_virtual(self, a_slots):
+        meta = self.extract_meta(self.book, a_slots)
+        self.book = None
+        return meta
+
+    def get_value_virtual(self, a_item, a_fallbacks=None):
+        if self.meta is None:
+            raise Exception('Book is not opened')
         try:
-            fname = XmlWrapper.get_tag_value(a_element, 'first-name')
-        except:
-            fname = ' '
+            return self.meta.get_value(a_item, a_fallbacks)
+        except Exception as e:
+            if self.parse_error is None:
+                raise
+            raise Exception(
+                Common.get_error_text(e) + '; ' + self.parse_error)
+
+
+class Book_inpx(Book):
+    fields = [
+        'AUTHOR', 'GENRE', 'TITLE', 'SERIES', 'SERNO', 'FILE', 'SIZE',
+        'LIBID', 'DEL', 'EXT', 'DATE', 'LANG', 'LIBRATE', 'KEYWORDS'
+    ]
+
+    def __init__(self, a_inpx):
+        super(Book_inpx, self).__init__()
+        self.format = 'inpx'
+        self.extensions = Book_fb2.extensions
+        self.inpx = a_inpx
+        self.records = {}
+        self.record = None
+        with zipfile.ZipFile(a_inpx) as archive:
+            fields = self.fields
+            if 'structure.info' in archive.namelist():
+                fields = archive.read('structure.info').decode('utf-8')
+                fields = [f.strip().upper() for f in fields.split(';')
+                          if f.strip()]
+            for info in archive.infolist():
+                if info.filename.lower().endswith('.inp'):
+                    folder = os.path.splitext(
+                        os.path.basename(info.filename))[0]
+                    self.load_inp(folder, archive.read(info), fields)
+
+    def load_inp(self, a_folder, a_data, a_fields):
+        for line in a_data.decode('utf-8').splitlines():
+            if not line:
+                continue
+            record = dict(zip(a_fields, line.split(u'\x04')))
+            name = record.get('FILE')
+            if not name or record.get('DEL', u'').strip() == u'1':
+                continue
+            self.records[(a_folder, name)] = record
+
+    @staticmethod
+    def split_list(a_value):
+        return [v for v in (a_value or u'').split(u':') if v.strip()]
+
+    @staticmethod
+    def get_meta(a_record):
+        meta = BookMeta()
+        for author in Book_inpx.split_list(a_record.get('AUTHOR')):
+            names = (author.split(u',') + [u'', u''])[:3]
+            meta.authors.append((names[1], names[2], names[0]))
+        meta.genres = Book_inpx.split_list(a_record.get('GENRE'))
+        meta.title = a_record.get('TITLE') or None
+        if a_record.get('SERIES'):
+            meta.sequences.append(
+                (a_record['SERIES'], a_record.get('SERNO') or None))
+        meta.date = a_record.get('DATE') or None
+        meta.lang = a_record.get('LANG') or None
+        return meta
+
+    def find(self, a_path):
+        name = os.path.basename(a_path)
+        name = name[:len(name) - len(self.get_extension(a_path))]
+        folder = os.path.basename(os.path.dirname(os.path.abspath(a_path)))
+        folder = os.path.splitext(folder)[0]
+        if isinstance(name, str):
+            encoding = sys.getfilesystemencoding() or 'utf-8'
+            name = name.decode(encoding, 'replace')
+            folder = folder.decode(encoding, 'replace')
+        return self.records.get((folder, name))
+
+    def lookup(self, a_path, a_key):
+        record = self.find(a_path)
+        if record is None:
+            return None
+        return self.get_meta(record)
+
+    def open_virtual(self, a_path):
+        self.record = self.find(a_path)
+        if self.record is None:
+            raise Exception('There is no ' + a_path + ' in ' + self.inpx)
+
+    def extract_virtual(self, a_slots):
+        return self.get_meta(self.record)
+
+    def close(self):
+        pass
+
+    def get_value_virtual(self, a_item, a_fallbacks=None):
+        if self.meta is None:
+            raise Exception('Book is not opened')
+        return self.meta.get_value(a_item, a_fallbacks)
+
+
+class LibraryArchive(object):
+    outputs = ['files', 'zip', 'repack']
+    block_size = 1 << 20
+
+    def __init__(self, a_path):
+        self.path = a_path
+        self.zip = zipfile.ZipFile(a_path)
+        self.raw = open(a_path, 'rb')
+        self.members = collections.OrderedDict()
+        self.others = []
+        for info in self.zip.infolist():
+            if info.filename.endswith('.fb2'):
+                self.members[os.path.join(a_path, info.filename)] = info
+            else:
+                self.others.append(info)
+
+    @staticmethod
+    def is_archive(a_path):
+        name = a_path.lower()
+        return name.endswith('.zip') and not name.endswith('.fb2.zip')
+
+    def open(self, a_info):
+        return contextlib.closing(self.zip.open(a_info))
+
+    def get_data_offset(self, a_info):
+        self.raw.seek(a_info.header_offset)
+        header = self.raw.read(30)
+        if len(header) != 30 or header[:4] != 'PK\x03\x04':
+            raise IOError('Bad member header: ' + a_info.filename)
+        name_size, extra_size = struct.unpack('<2H', header[26:30])
+        return a_info.header_offset + 30 + name_size + extra_size
+
+    def copy_raw(self, a_info, a_dest, a_name):
+        if a_info.flag_bits & 0x1:
+            raise IOError('Member is encrypted: ' + a_info.filename)
+        offset = self.get_data_offset(a_info)
+        info = zipfile.ZipInfo(a_name.replace(os.sep, '/'), a_info.date_time)
+        info.compress_type = a_info.compress_type
+        info.CRC = a_info.CRC
+        info.compress_size = a_info.compress_size
+        info.file_size = a_info.file_size
+        info.external_attr = a_info.external_attr
+        info.header_offset = a_dest.fp.tell()
+        a_dest.fp.write(info.FileHeader())
+        self.raw.seek(offset)
+        remaining = a_info.compress_size
+        while remaining:
+            data = self.raw.read(min(remaining, self.block_size))
+            if not data:
+                raise IOError('Member is truncated: ' + a_info.filename)
+            a_dest.fp.write(data)
+            remaining -= len(data)
+        a_dest.filelist.append(info)
+        a_dest.NameToInfo[info.filename] = info
+        a_dest._didModify = True
+
+    def extract(self, a_info, a_target):
+        temp = a_target + '.fb2rename'
         try:
-            lname = XmlWrapper.get_tag_value(a_element, 'last-name')
+            with self.open(a_info) as src:
+                with open(temp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, self.block_size)
+            os.rename(temp, a_target)
         except:
-            lname = ' '
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def pack(self, a_info, a_target, a_name):
+        temp = a_target + '.fb2rename'
         try:
-            mname = XmlWrapper.get_tag_value(a_element, 'middle-name')
+            dest = zipfile.ZipFile(temp, 'w', allowZip64=True)
+            try:
+                self.copy_raw(a_info, dest, a_name)
+            finally:
+                dest.close()
+            os.rename(temp, a_target)
         except:
-            mname = ' '
-        return Book.format_person_name(fname, mname, lname, a_format)
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
 
-    def get_authors(self, _format):
-        author_format = _format.replace('authors', '').strip()
-        if not author_format:
-            author_format = '#L, #F #M'
-        authors_tag = XmlWrapper.get_multitag_by_path(
-            self.book, self.title_tags['authors'])
-        if not authors_tag:
-            raise Exception("There's no author")
-            return ''
-        authors = []
-        for tag in authors_tag:
-            author = self.get_person_name(tag, author_format)
-            if author is not None:
-                authors.append(author)
-        return '; '.join(authors)
+    def close(self):
+        self.zip.close()
+        self.raw.close()
+
+
+class Book_fb2_member(Book_fb2):
+
+    def __init__(self, a_archive, a_header_only=True):
+        super(Book_fb2_member, self).__init__(a_header_only)
+        self.archive = a_archive
+
+    def exists(self, a_path):
+        return a_path in self.archive.members
+
+    def get_size(self, a_path):
+        return self.archive.members[a_path].file_size
 
-    def get_sequence(self):
-        attrs = XmlWrapper.get_all_tag_atributes(
-            self.book, self.title_tags['sequence'])
-        name = ''
-        if 'name' in attrs.keys():
-            name = attrs['name']
-        num = ''
-        if 'number' in attrs.keys():
-            num = attrs['number']
-        return '-'.join([name, num])
-
-    def get_date(self):
-        attrs = XmlWrapper.get_all_tag_atributes(
-            self.book, self.title_tags['date'])
-        if not attrs:
-            raise Exception("There's no date")
-        val = ''
-        if 'value' in attrs.keys():
-            val = strptime(attrs['value'], "%Y-%m-%d")
-        return val
-
-    def get_value_virtual(self, a_item):
-        value = ''
-        if re.match('authors', a_item):
-            value = self.get_authors(a_item)
-        elif a_item == 'sequence':
-            value = self.get_sequence()
-        elif a_item == 'seq_name':
-            value = XmlWrapper.get_tag_atribute(
-                self.book, self.title_tags['sequence'], 'name')
-        elif a_item == 'seq_number':
-            value = XmlWrapper.get_tag_atribute(
-                self.book, self.title_tags['sequence'], 'number')
-        elif a_item == 'oldname':
-            value = self.get_oldname()
-        elif a_item == 'date':
-            dt = self.get_date()
-            value = strftime("%Y-%m-%d", dt)
-        elif a_item == 'year':
-            dt = self.get_date()
-            value = strftime("%Y", dt)
-        elif a_item in self.title_tags.keys():
-            value = XmlWrapper.get_tag_value(
-                self.book, self.title_tags[a_item])
-        elif a_item in self.document_tags.keys():
-            value = XmlWrapper.get_tag_value(
-                self.book, self.document_tags[a_item])
-        elif a_item in self.publish_tags.keys():
-            value = XmlWrapper.get_tag_value(
-                self.book, self.publish_tags[a_item])
-
-        if value is None:
-            raise Exception("There's no " + a_item)
-            value = ''
-        return Common.validate_tag(value)
+    def open_book(self, a_path):
+        return self.archive.open(self.archive.members[a_path])
+
+
+class NameTemplate(object):
+    field_re = re.compile(r'%([A-Za-z_]+)([^%]*)%')
+
+    def __init__(self, a_format, a_fallbacks=None):
+        self.format = a_format
+        if a_fallbacks is None:
+            a_fallbacks = BookMeta.fallbacks
+        self.fallbacks = a_fallbacks
+        self.tokens = []
+        self.fields = []
+        self.unknown = []
+        self.invalid = []
+        self.compile()
+
+    def compile(self):
+        patterns = Common.get_format_patterns()
+        pos = 0
+        found = self.field_re.search(self.format)
+        while found:
+            if found.group(1) not in patterns:
+                self.unknown.append(found.group(0))
+                found = self.field_re.search(self.format, found.start() + 1)
+                continue
+            if found.group(1) == 'hash':
+                digits = found.group(2).strip()
+                if digits and not (digits.isdigit() and 0 < int(digits) <= 40):
+                    self.invalid.append(found.group(0))
+            if pos < found.start():
+                self.tokens.append((False, self.format[pos:found.start()]))
+            self.tokens.append((True, found.group(1) + found.group(2)))
+            if found.group(1) not in self.fields:
+                self.fields.append(found.group(1))
+            pos = found.end()
+            found = self.field_re.search(self.format, pos)
+        if pos < len(self.format):
+            self.tokens.append((False, self.format[pos:]))
+
+    def validate(self):
+        if self.unknown:
+            raise Exception(
+                'Unknown fields in format: ' + ', '.join(self.unknown))
+        if self.invalid:
+            raise Exception(
+                'Hash length must be 1 to 40 digits: ' +
+                ', '.join(self.invalid))
+
+    def render(self, a_book):
+        result = []
+        for is_field, value in self.tokens:
+            if is_field:
+                value = a_book.get_value(value, self.fallbacks)
+            result.append(value)
+        return ''.join(result)
 
 
 def format_name(a_book, _format):
-    result = _format
-    for ptrn in Common.get_format_patterns():
-        re_ptrn = '%' + ptrn + '.*?%'
-        ptrn_found = re.search(re_ptrn, result)
-        while ptrn_found:
-            pf_str = ptrn_found.group(0)
-            value = a_book.get_value(pf_str.replace('%', ''))
-            result = re.sub(re_ptrn, value, result, 1)
-            ptrn_found = re.search(re_ptrn, result)
-    return result
+    if not isinstance(_format, NameTemplate):
+        _format = NameTemplate(_format)
+    return _format.render(a_book)
 
 
-def get_files_to_work_with(a_files=[], a_types=[], a_path=[], a_recursive=False):
-    if not isinstance(a_types, list):
-        return []
-    if not isinstance(a_path, list):
-        return []
-    result = []
-    candidates = []
-    candidates.extend(a_files)
-
-    def get_files_plain(a_dir):
-        lsdir = []
-        if os.path.isdir(a_dir):
-            lsdir = os.listdir(a_dir)
-            lsdir = [os.path.join(a_dir, i) for i in lsdir]
-            lsdir = [f for f in lsdir if os.path.isfile(f)]
-        return lsdir
-
-    def get_files_recursive(a_dir):
-        lsdir = []
-        if os.path.isdir(a_dir):
-            for f in content:
-                curr_subdir_name = f[0]
-                curr_subdir_files = f[2]
-                for fc in curr_subdir_files:
-                    lsdir.append(os.path.join(p, curr_subdir_name, fc))
-        return lsdir
-
-    if not candidates and not a_path:
-        a_path.append(os.getcwd())
-    for p in a_path:
-        if os.path.isdir(p):
-            content = os.walk(p)
-            lsdir = []
-            if a_recursive:
-                lsdir = get_files_recursive(p)
-            else:
-                lsdir = get_files_plain(p)
-            candidates.extend(lsdir)
-    candidates = [os.path.abspath(f) for f in candidates]
-    candidates = list(set(candidates))
-    extensions = [('.' + ext) for ext in a_types]
-    for f in candidates:
-        if 0 < len([e for e in extensions if f.endswith(e)]):
-            result.append(f)
-    return result
+class MetaCache(object):
+    version = 1
+    commit_every = 1000
 
+    def __init__(self, a_path, a_max_entries=1000000):
+        self.path = a_path
+        self.max_entries = a_max_entries
+        self.pending = 0
+        Common.ensure_path_exists(os.path.dirname(os.path.abspath(a_path)))
+        self.db = sqlite3.connect(a_path)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.version:
+            self.db.execute('DROP TABLE IF EXISTS meta')
+            self.db.execute('PRAGMA user_version = %d' % self.version)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS meta (dev INTEGER, ino INTEGER, '
+            'size INTEGER, mtime INTEGER, used INTEGER, data TEXT, '
+            'PRIMARY KEY (dev, ino))')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS meta_used ON meta (used)')
+        self.now = int(time.time())
 
-def manage_cmd():
-    parser = argparse.ArgumentParser(
-        description='Renames given single fb2 file using pattern.')
-    parser.add_argument(
-        'fname', metavar='fb2_file_names', type=str, nargs='*',
-        help='name of the files to rename')
-    parser.add_argument(
-        '--format', '-f', dest='format', action='store',
-        help='Format of the new name. Possble values are: ' +
-        ', '.join(Common.get_format_patterns()) + '.\n' +
-        'Author name could be #F/M/L like #First/Middle/Last name.'
-    )
-    parser.add_argument(
-        '--template', '-t', metavar='template', action='store',
-        default='default',
-        help='Predefined formats. Possble value are: ' +
-        ', '.join(Common.get_templates()) + '.'
-    )
-    parser.add_argument(
-        '--dry-run', '-d', dest='dryrun', action='store_true',
-        default=False,
-        help='Do not rename files. Just show new names.')
-    parser.add_argument(
-        '--recursive', '-r', dest='recursive', type=bool, action='store',
-        default=False,
-        help='Scan given directories recursively.'
-    )
-    parser.add_argument(
-        '-o', dest='out_dir', action='store',
-        default='',
-        help='Output directory')
-    args = parser.parse_args()
-    return args
+    @staticmethod
+    def get_default_path():
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'fb2rename', 'meta.sqlite')
 
+    @staticmethod
+    def get_key(a_path):
+        st = os.stat(a_path)
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        return (st.st_dev, st.st_ino, st.st_size, mtime)
 
-def main():
-    args = manage_cmd()
-    errors = {}
-    if args.out_dir and os.path.isdir(args.out_dir):
-        out_dir = args.out_dir
-    else:
-        out_dir = os.getcwd()
-    book = Book_fb2()
-    templates = Common.get_templates()
-    if args.template not in templates:
-        errors['template'] = 'No such template: ' + args.template
-    else:
-        name_format = templates[args.template]
-        if args.format:
-            name_format = args.format
-        input_files = get_files_to_work_with(args.fname, ['fb2'], a_recursive=args.recursive)
-        for fname in input_files:
+    def get(self, a_key):
+        row = self.db.execute(
+            'SELECT size, mtime, data FROM meta WHERE dev = ? AND ino = ?',
+            a_key[:2]).fetchone()
+        if row is None or tuple(row[:2]) != a_key[2:]:
+            return None
+        self.db.execute(
+            'UPDATE meta SET used = ? WHERE dev = ? AND ino = ?',
+            (self.now,) + a_key[:2])
+        self.written()
+        meta = BookMeta()
+        meta.__setstate__(json.loads(row[2]))
+        return meta
+
+    def put(self, a_key, a_meta):
+        self.db.execute(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?, ?)',
+            a_key + (self.now, json.dumps(a_meta.__getstate__())))
+        self.written()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.db.commit()
+            self.pending = 0
+
+    def evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM meta').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM meta WHERE rowid IN (SELECT rowid FROM meta '
+                'ORDER BY used LIMIT ?)', (count - self.max_entries,))
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+
+class FileOps(object):
+    modes = ['move', 'link', 'reflink', 'copy']
+    FICLONE = 0x40049409
+    chunk_size = 1 << 30
+    libc = None
+
+    @staticmethod
+    def apply(a_mode, a_src, a_dst):
+        if a_mode not in FileOps.modes:
+            raise Exception('No such mode: ' + a_mode)
+        getattr(FileOps, a_mode)(a_src, a_dst)
+
+    @staticmethod
+    def move(a_src, a_dst):
+        try:
+            os.rename(a_src, a_dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            FileOps.copy(a_src, a_dst)
+            os.remove(a_src)
+
+    @staticmethod
+    def is_same(a_src, a_dst):
+        return os.path.exists(a_dst) and os.path.samefile(a_src, a_dst)
+
+    @staticmethod
+    def link(a_src, a_dst):
+        if FileOps.is_same(a_src, a_dst):
+            return
+        temp = a_dst + '.fb2rename'
+        os.link(a_src, temp)
+        try:
+            os.rename(temp, a_dst)
+        except:
+            os.remove(temp)
+            raise
+
+    @staticmethod
+    def reflink(a_src, a_dst):
+        if fcntl is None:
+            raise Exception('reflink is not supported on this platform')
+        FileOps.clone(a_src, a_dst, lambda src, dst, size:
+                      fcntl.ioctl(dst, FileOps.FICLONE, src))
+
+    @staticmethod
+    def copy(a_src, a_dst):
+        FileOps.clone(a_src, a_dst, FileOps.copy_data)
+
+    @staticmethod
+    def clone(a_src, a_dst, a_func):
+        if FileOps.is_same(a_src, a_dst):
+            return
+        temp = a_dst + '.fb2rename'
+        try:
+            with open(a_src, 'rb') as src:
+                with open(temp, 'wb') as dst:
+                    a_func(src.fileno(), dst.fileno(),
+                           os.fstat(src.fileno()).st_size)
+                    os.fsync(dst.fileno())
+            shutil.copystat(a_src, temp)
+            os.rename(temp, a_dst)
+        except:
+            error = sys.exc_info()
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise error[0], error[1], error[2]
+
+    @staticmethod
+    def copy_data(a_src_fd, a_dst_fd, a_size):
+        copy_chunks = [
+            FileOps.copy_file_range, FileOps.sendfile, FileOps.read_write]
+        offset = 0
+        while offset < a_size:
+            count = min(a_size - offset, FileOps.chunk_size)
             try:
-                book.open(fname)
-                name = format_name(book, name_format)
-                if not name:
-                    raise Exception('Result filename is empty')
-                name = unicode(Common.validate_filename(name + '.fb2'))
-            except:
-                errors[fname] = sys.exc_info()[1]
+                copied = copy_chunks[0](a_src_fd, a_dst_fd, offset, count)
+            except OSError as e:
+                if len(copy_chunks) == 1 or e.errno not in (
+                        errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP):
+                    raise
+                copy_chunks.pop(0)
                 continue
-            name = name.strip('\n ')
-            print fname, ' => ', name
-            if not args.dryrun:
-                try:
-                    name = os.path.join(out_dir, name)
-                    Common.ensure_path_exists(os.path.dirname(name))
-                    os.rename(fname, name)
-                except:
-                    errors[fname] = sys.exc_info()[1]
+            if copied == 0:
+                break
+            offset += copied
 
-    print 'Errors: '
-    for e in errors:
-        print '  ' + e + ':', errors[e]
+    @staticmethod
+    def copy_file_range(a_src_fd, a_dst_fd, a_offset, a_count):
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+        return os.copy_file_range(
+            a_src_fd, a_dst_fd, a_count, a_offset, a_offset)
+
+    @staticmethod
+    def sendfile(a_src_fd, a_dst_fd, a_offset, a_count):
+        if hasattr(os, 'sendfile'):
+            return os.sendfile(a_dst_fd, a_src_fd, a_offset, a_count)
+        if FileOps.libc is None:
+            FileOps.libc = ctypes.CDLL(
+                ctypes.util.find_library('c'), use_errno=True)
+        sendfile = getattr(FileOps.libc, 'sendfile64', None)
+        if sendfile is None:
+            raise OSError(errno.ENOSYS, 'sendfile is not available')
+        offset = ctypes.c_int64(a_offset)
+        sent = sendfile(
+            a_dst_fd, a_src_fd, ctypes.byref(offset), ctypes.c_size_t(a_count))
+        if sent < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return sent
+
+    @staticmethod
+    def read_write(a_src_fd, a_dst_fd, a_offset, a_count):
+        os.lseek(a_src_fd, a_offset, os.SEEK_SET)
+        data = os.read(a_src_fd, min(a_count, 1 << 20))
+        return os.write(a_dst_fd, data)
+
+
+class RenameItem(object):
+    __slots__ = (
+        'fname', 'name', 'meta', 'error', 'size', 'parse_time', 'format_time',
+        'target', 'base', 'duplicate', 'skipped')
+
+    def __init__(self, a_fname, a_name=None, a_meta=None, a_error=None):
+        self.fname = a_fname
+        self.name = a_name
+        self.meta = a_meta
+        self.error = a_error
+        self.size = 0
+        self.parse_time = 0.0
+        self.format_time = 0.0
+        self.target = None
+        self.base = None
+        self.duplicate = None
+        self.skipped = None
+
+    def to_dict(self):
+        fields = None
+        if self.meta is not None:
+            fields = self.meta.__getstate__()
+            fields['oldname'] = Common.decode_path(fields['oldname'])
+        error = None
+        if self.error is not None:
+            error = Common.get_error_text(self.error)
+        return {
+            'old': Common.decode_path(self.fname),
+            'new': Common.decode_path(self.target),
+            'base': Common.decode_path(self.base), 'fields': fields,
+            'error': error, 'duplicate': Common.decode_path(self.duplicate),
+            'skipped': Common.decode_path(self.skipped)
+        }
+
+    def __getstate__(self):
+        state = [getattr(self, slot) for slot in self.__slots__]
+        if self.error is not None:
+            error_type = Exception
+            if isinstance(self.error, LimitError):
+                error_type = LimitError
+            state[3] = error_type(Common.get_error_text(self.error))
+        return state
+
+    def __setstate__(self, a_state):
+        for slot, value in zip(self.__slots__, a_state):
+            setattr(self, slot, value)
+
+
+def compute_name(a_book, a_fname, a_template, a_meta=None, a_fields=None):
+    item = RenameItem(a_fname)
+    start = default_timer()
+    parsed = None
+    try:
+        item.size = a_book.get_size(a_fname)
+        if a_meta is None:
+            a_book.open(a_fname, a_fields, a_template.fallbacks)
+        else:
+            a_book.load(a_fname, a_meta)
+        item.meta = a_book.meta
+        parsed = default_timer()
+        name = format_name(a_book, a_template)
+        if not name:
+            raise Exception('Result filename is empty')
+        name = unicode(Common.validate_filename(
+            name + a_book.get_extension(a_fname)))
+        item.name = name.strip('\n ')
+    except:
+        item.error = sys.exc_info()[1]
+    finished = default_timer()
+    if parsed is None:
+        parsed = finished
+    item.parse_time = parsed - start
+    item.format_time = finished - parsed
+    return item
+
+
+worker_state = {}
+
+
+def init_worker(a_format, a_header_only, a_fields, a_sanitizer, a_fallbacks,
+                a_limits):
+    Common.sanitizer = a_sanitizer
+    Book_fb2.limits = a_limits
+    worker_state['book'] = Book_fb2(a_header_only)
+    worker_state['template'] = NameTemplate(a_format, a_fallbacks)
+    worker_state['fields'] = a_fields
+
+
+def compute_names_worker(a_files):
+    book = worker_state['book']
+    template = worker_state['template']
+    fields = worker_state['fields']
+    return [
+        compute_name(book, fname, template, meta, fields)
+        for fname, meta in a_files]
+
+
+def iter_chunks(a_items, a_size):
+    a_items = iter(a_items)
+    chunk = list(itertools.islice(a_items, a_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(a_items, a_size))
+
+
+def ordered_imap(a_pool, a_func, a_items, a_depth):
+    pending = collections.deque()
+    for item in a_items:
+        pending.append(a_pool.apply_async(a_func, (item,)))
+        if len(pending) >= a_depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class RunStats(object):
+    phases = ['discovery', 'schedule', 'parse', 'format', 'rename']
+
+    def __init__(self, a_slowest=10, a_progress=0, a_stream=sys.stderr):
+        self.started = default_timer()
+        self.finished = None
+        self.totals = dict.fromkeys(self.phases, 0.0)
+        self.latencies = array.array('d')
+        self.slowest = []
+        self.slowest_count = a_slowest
+        self.files = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.progress = a_progress
+        self.last_progress = self.started
+        self.stream = a_stream
+        self.schedule = None
+
+    def timed(self, a_phase, a_items):
+        a_items = iter(a_items)
+        while True:
+            start = default_timer()
+            try:
+                item = next(a_items)
+            except StopIteration:
+                self.totals[a_phase] += default_timer() - start
+                return
+            self.totals[a_phase] += default_timer() - start
+            yield item
+
+    def add(self, a_item, a_rename_time=0.0):
+        latency = a_item.parse_time + a_item.format_time + a_rename_time
+        self.totals['parse'] += a_item.parse_time
+        self.totals['format'] += a_item.format_time
+        self.totals['rename'] += a_rename_time
+        self.files += 1
+        self.bytes += a_item.size
+        if a_item.error is not None:
+            self.errors += 1
+        if a_item.skipped is not None:
+            self.skipped += 1
+        self.latencies.append(latency)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, (latency, a_item.fname))
+        elif self.slowest and latency > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (latency, a_item.fname))
+        if self.progress > 0:
+            now = default_timer()
+            if now - self.last_progress >= self.progress:
+                self.last_progress = now
+                self.stream.write('%d files, %.1f files/s, %d errors\n' % (
+                    self.files, self.files / (now - self.started),
+                    self.errors))
+
+    def finish(self):
+        self.finished = default_timer()
+
+    @staticmethod
+    def get_percentile(a_sorted, a_percent):
+        if not a_sorted:
+            return 0.0
+        index = int(round(a_percent / 100.0 * (len(a_sorted) - 1)))
+        return a_sorted[index]
+
+    def get_summary(self):
+        if self.finished is None:
+            self.finish()
+        elapsed = self.finished - self.started
+        latencies = sorted(self.latencies)
+        summary = {
+            'files': self.files,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'bytes': self.bytes,
+            'seconds': elapsed,
+            'files_per_second': self.files / elapsed if elapsed else 0.0,
+            'mb_per_second':
+                self.bytes / elapsed / 1000000.0 if elapsed else 0.0,
+            'phases': dict(self.totals),
+            'latency': dict(
+                ('p%d' % p, self.get_percentile(latencies, p))
+                for p in (50, 95, 99)),
+            'slowest': [
+                {'file': fname, 'seconds': latency}
+                for latency, fname in sorted(self.slowest, reverse=True)]
+        }
+        if self.schedule is not None:
+            summary['schedule'] = self.schedule
+        return summary
+
+    def format_summary(self):
+        summary = self.get_summary()
+        lines = [
+            'Stats: ',
+            '  %d files, %d errors, %d skipped, %.1f MB in %.2fs' % (
+                summary['files'], summary['errors'], summary['skipped'],
+                summary['bytes'] / 1000000.0, summary['seconds']),
+            '  %.1f files/s, %.2f MB/s' % (
+                summary['files_per_second'], summary['mb_per_second']),
+            '  phases: ' + ', '.join(
+                '%s %.3fs' % (p, summary['phases'][p]) for p in self.phases),
+            '  latency: ' + ', '.join(
+                '%s %.2fms' % (p, summary['latency'][p] * 1000)
+                for p in ('p50', 'p95', 'p99'))
+        ]
+        schedule = summary.get('schedule')
+        if schedule is not None:
+            lines.append(
+                '  order %s: %d -> %d seeks, ~%.1fs seek time saved '
+                '(%dms per seek)' % (
+                    schedule['order'], schedule['seeks_before'],
+                    schedule['seeks_after'], schedule['seconds_saved'],
+                    Scheduler.seek_time * 1000))
+        if summary['slowest']:
+            lines.append('  slowest: ')
+            for entry in summary['slowest']:
+                lines.append('    %.2fms %s' % (
+                    entry['seconds'] * 1000, entry['file']))
+        return lines
+
+
+def lookup_cached(a_files, a_cache, a_keys, a_sources=()):
+    for fname in a_files:
+        meta = None
+        key = None
+        if a_cache is not None or a_sources:
+            try:
+                key = MetaCache.get_key(fname)
+            except OSError:
+                key = None
+        for source in a_sources:
+            meta = source.lookup(fname, key)
+            if meta is not None:
+                break
+        if meta is None and key is not None and a_cache is not None:
+            meta = a_cache.get(key)
+            if meta is None:
+                a_keys[fname] = key
+        yield fname, meta
+
+
+class Catalog(object):
+    version = 1
+    commit_every = 1000
+
+    def __init__(self, a_path):
+        self.path = a_path
+        self.pending = 0
+        self.seen = set()
+        self.db = sqlite3.connect(a_path)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.version:
+            tables = self.db.execute(
+                'SELECT COUNT(*) FROM sqlite_master').fetchone()[0]
+            if version or tables:
+                self.db.close()
+                raise sqlite3.DatabaseError(
+                    'Not a catalog of version %d: %s' % (self.version, a_path))
+            self.db.execute('PRAGMA user_version = %d' % self.version)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, dev INTEGER,
+                ino INTEGER, size INTEGER, mtime INTEGER, title TEXT,
+                lang TEXT, date TEXT, year TEXT, doc_id TEXT, isbn TEXT,
+                publisher TEXT, meta TEXT);
+            CREATE TABLE IF NOT EXISTS authors (
+                book_id INTEGER, first TEXT, middle TEXT, last TEXT,
+                name TEXT);
+            CREATE TABLE IF NOT EXISTS sequences (
+                book_id INTEGER, name TEXT, number TEXT);
+            CREATE TABLE IF NOT EXISTS genres (book_id INTEGER, genre TEXT);
+            CREATE INDEX IF NOT EXISTS authors_name ON authors (last, first);
+            CREATE INDEX IF NOT EXISTS authors_book ON authors (book_id);
+            CREATE INDEX IF NOT EXISTS sequences_name ON sequences (name);
+            CREATE INDEX IF NOT EXISTS sequences_book ON sequences (book_id);
+            CREATE INDEX IF NOT EXISTS genres_genre ON genres (genre);
+            CREATE INDEX IF NOT EXISTS genres_book ON genres (book_id);
+        ''')
+
+    @staticmethod
+    def open(a_path):
+        if a_path.lower().endswith('.csv'):
+            return CsvCatalog(a_path)
+        return Catalog(a_path)
+
+    @staticmethod
+    def get_path_key(a_path):
+        return Common.decode_path(os.path.abspath(a_path))
+
+    @staticmethod
+    def get_year(a_meta):
+        if a_meta.date:
+            return a_meta.date[:4]
+        return a_meta.year
+
+    def get_row(self, a_path):
+        return self.db.execute(
+            'SELECT id, dev, ino, size, mtime, meta FROM books '
+            'WHERE path = ?', (self.get_path_key(a_path),)).fetchone()
+
+    def lookup(self, a_path, a_key):
+        row = self.get_row(a_path)
+        if row is None or tuple(row[1:5]) != a_key:
+            return None
+        meta = BookMeta()
+        meta.__setstate__(json.loads(row[5]))
+        return meta
+
+    def is_current(self, a_path, a_key):
+        row = self.get_row(a_path)
+        if row is None or tuple(row[1:5]) != a_key:
+            return False
+        self.seen.add(row[0])
+        return True
+
+    def delete(self, a_id):
+        for table in ('authors', 'sequences', 'genres'):
+            self.db.execute(
+                'DELETE FROM ' + table + ' WHERE book_id = ?', (a_id,))
+        self.db.execute('DELETE FROM books WHERE id = ?', (a_id,))
+
+    def put(self, a_path, a_key, a_meta):
+        row = self.get_row(a_path)
+        if row is not None:
+            self.delete(row[0])
+        cursor = self.db.execute(
+            'INSERT INTO books (path, dev, ino, size, mtime, title, lang, '
+            'date, year, doc_id, isbn, publisher, meta) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.get_path_key(a_path),) + tuple(a_key) + (
+                a_meta.title, a_meta.lang, a_meta.date, self.get_year(a_meta),
+                a_meta.doc_id, a_meta.isbn, a_meta.publisher,
+                json.dumps(a_meta.__getstate__())))
+        book_id = cursor.lastrowid
+        self.seen.add(book_id)
+        self.db.executemany(
+            'INSERT INTO authors VALUES (?, ?, ?, ?, ?)',
+            [(book_id, first, middle, last,
+              u' '.join(n for n in (last, first, middle) if n))
+             for first, middle, last in a_meta.authors])
+        self.db.executemany(
+            'INSERT INTO sequences VALUES (?, ?, ?)',
+            [(book_id, name, number) for name, number in a_meta.sequences])
+        self.db.executemany(
+            'INSERT INTO genres VALUES (?, ?)',
+            [(book_id, genre) for genre in a_meta.genres])
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.db.commit()
+            self.pending = 0
+
+    def prune(self):
+        ids = [r[0] for r in self.db.execute('SELECT id FROM books')]
+        removed = 0
+        for book_id in ids:
+            if book_id not in self.seen:
+                self.delete(book_id)
+                removed += 1
+        return removed
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class CsvCatalog(object):
+    columns = [
+        'path', 'dev', 'ino', 'size', 'mtime', 'title', 'authors', 'sequence',
+        'seq_number', 'genres', 'lang', 'date', 'year', 'doc_id', 'meta'
+    ]
+
+    def __init__(self, a_path):
+        self.path = a_path
+        self.rows = {}
+        self.seen = set()
+        self.changed = False
+        if os.path.exists(a_path):
+            with open(a_path, 'rb') as f:
+                for row in csv.DictReader(f):
+                    path = row['path'].decode('utf-8')
+                    self.rows[path] = row
+
+    def get_identity(self, a_row):
+        return tuple(int(a_row[c]) for c in ('dev', 'ino', 'size', 'mtime'))
+
+    def lookup(self, a_path, a_key):
+        row = self.rows.get(Catalog.get_path_key(a_path))
+        if row is None or self.get_identity(row) != a_key:
+            return None
+        meta = BookMeta()
+        meta.__setstate__(json.loads(row['meta']))
+        return meta
+
+    def is_current(self, a_path, a_key):
+        path = Catalog.get_path_key(a_path)
+        row = self.rows.get(path)
+        if row is None or self.get_identity(row) != a_key:
+            return False
+        self.seen.add(path)
+        return True
+
+    def put(self, a_path, a_key, a_meta):
+        path = Catalog.get_path_key(a_path)
+        sequence = (u'', u'')
+        if a_meta.sequences:
+            sequence = a_meta.sequences[0]
+        values = [path] + list(a_key) + [
+            a_meta.title,
+            u'; '.join(u' '.join(n for n in (l, f, m) if n)
+                       for f, m, l in a_meta.authors),
+            sequence[0], sequence[1], u':'.join(a_meta.genres), a_meta.lang,
+            a_meta.date, Catalog.get_year(a_meta), a_meta.doc_id,
+            json.dumps(a_meta.__getstate__())]
+        row = {}
+        for column, value in zip(self.columns, values):
+            if value is None:
+                value = ''
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row[column] = str(value)
+        self.rows[path] = row
+        self.seen.add(path)
+        self.changed = True
+
+    def prune(self):
+        removed = [p for p in self.rows if p not in self.seen]
+        for path in removed:
+            del self.rows[path]
+            self.changed = True
+        return len(removed)
+
+    def close(self):
+        if not self.changed:
+            return
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            writer = csv.DictWriter(f, self.columns)
+            writer.writeheader()
+            for path in sorted(self.rows):
+                writer.writerow(self.rows[path])
+        os.rename(temp, self.path)
+
+
+def index_books(a_files, a_catalog, a_header_only=True, a_jobs=1):
+    keys = {}
+
+    def changed_files():
+        for fname in a_files:
+            try:
+                key = MetaCache.get_key(fname)
+            except OSError:
+                continue
+            if a_catalog.is_current(fname, key):
+                continue
+            keys[fname] = key
+            yield fname
+
+    items = compute_names(
+        changed_files(), NameTemplate('%oldname%'), a_header_only, a_jobs,
+        a_extra_fields=BookMeta.__slots__)
+    for item in items:
+        key = keys.pop(item.fname)
+        if item.meta is not None:
+            a_catalog.put(item.fname, key, item.meta)
+        yield item
+
+
+class Prefetcher(object):
+    POSIX_FADV_WILLNEED = 3
+    libc = None
+
+    def __init__(self, a_threads=4, a_depth=64, a_size=65536):
+        self.threads = a_threads
+        self.depth = max(a_depth, a_threads)
+        self.size = a_size
+
+    @staticmethod
+    def fadvise(a_fd, a_offset, a_length):
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(
+                a_fd, a_offset, a_length, Prefetcher.POSIX_FADV_WILLNEED)
+            return
+        if Prefetcher.libc is None:
+            Prefetcher.libc = ctypes.CDLL(
+                ctypes.util.find_library('c'), use_errno=True)
+        fadvise = getattr(Prefetcher.libc, 'posix_fadvise64', None)
+        if fadvise is not None:
+            fadvise(a_fd, ctypes.c_int64(a_offset), ctypes.c_int64(a_length),
+                    Prefetcher.POSIX_FADV_WILLNEED)
+
+    def prefetch(self, a_path):
+        try:
+            fd = os.open(a_path, os.O_RDONLY)
+        except OSError:
+            return a_path
+        try:
+            self.fadvise(fd, 0, self.size)
+            os.read(fd, self.size)
+            if a_path.endswith('.zip'):
+                size = os.fstat(fd).st_size
+                if size > self.size:
+                    os.lseek(fd, size - self.size, os.SEEK_SET)
+                    os.read(fd, self.size)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return a_path
+
+    def iter(self, a_files):
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        try:
+            for path in ordered_imap(pool, self.prefetch, a_files, self.depth):
+                yield path
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class Scheduler(object):
+    orders = ['none', 'path', 'inode', 'extent']
+    FS_IOC_FIEMAP = 0xC020660B
+    seek_time = 0.008
+    near_bytes = 1 << 20
+    near_inodes = 64
+
+    def __init__(self, a_order='none', a_window=10000):
+        if a_order not in self.orders:
+            raise Exception('No such order: ' + a_order)
+        self.order = a_order
+        self.window = a_window
+        self.files = 0
+        self.seeks_before = 0
+        self.seeks_after = 0
+
+    @staticmethod
+    def get_extent(a_path):
+        if fcntl is None:
+            return None
+        fd = os.open(a_path, os.O_RDONLY)
+        try:
+            request = struct.pack(
+                '=QQLLLL', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * 56
+            reply = fcntl.ioctl(fd, Scheduler.FS_IOC_FIEMAP, request)
+        except IOError:
+            return None
+        finally:
+            os.close(fd)
+        if struct.unpack_from('=L', reply, 20)[0] == 0:
+            return None
+        return struct.unpack_from('=QQ', reply, 40)
+
+    def get_position(self, a_path):
+        st = os.stat(a_path)
+        if self.order == 'extent':
+            extent = self.get_extent(a_path)
+            if extent is not None:
+                physical, length = extent
+                return (st.st_dev, 0, physical, physical + length)
+        return (st.st_dev, 1, st.st_ino, st.st_ino + 1)
+
+    def is_seek(self, a_prev, a_curr):
+        if a_prev is None or a_curr is None:
+            return a_prev is not a_curr
+        if a_prev[:2] != a_curr[:2]:
+            return True
+        near = self.near_bytes if a_curr[1] == 0 else self.near_inodes
+        return abs(a_curr[2] - a_prev[3]) > near
+
+    def count_seeks(self, a_positions):
+        seeks = 0
+        prev = None
+        for position in a_positions:
+            if prev is not None and self.is_seek(prev, position):
+                seeks += 1
+            prev = position
+        return seeks
+
+    def schedule(self, a_files):
+        groups = collections.OrderedDict()
+        for fname in a_files:
+            groups.setdefault(os.path.dirname(fname), []).append(fname)
+        entries = []
+        for directory, names in groups.items():
+            for fname in names:
+                try:
+                    position = self.get_position(fname)
+                except OSError:
+                    position = None
+                entries.append((position, fname))
+        positions = dict((fname, position) for position, fname in entries)
+        before = self.count_seeks(positions[f] for f in a_files)
+        if self.order == 'path':
+            entries.sort(key=lambda e: e[1])
+        else:
+            entries.sort()
+        self.files += len(entries)
+        self.seeks_before += before
+        self.seeks_after += self.count_seeks(e[0] for e in entries)
+        return [fname for position, fname in entries]
+
+    def iter(self, a_files, a_stats=None):
+        if self.order == 'none':
+            for fname in a_files:
+                yield fname
+            return
+        for window in iter_chunks(a_files, self.window or sys.maxint):
+            start = default_timer()
+            files = self.schedule(window)
+            if a_stats is not None:
+                a_stats.totals['schedule'] += default_timer() - start
+                a_stats.schedule = self.get_summary()
+            for fname in files:
+                yield fname
+
+    def get_summary(self):
+        return {
+            'order': self.order,
+            'files': self.files,
+            'seeks_before': self.seeks_before,
+            'seeks_after': self.seeks_after,
+            'seconds_saved':
+                (self.seeks_before - self.seeks_after) * self.seek_time
+        }
+
+
+def compute_names(a_files, a_template, a_header_only=True, a_jobs=1,
+                  a_chunk_size=16, a_cache=None, a_extra_fields=[],
+                  a_sources=()):
+    keys = {}
+    files = lookup_cached(a_files, a_cache, keys, a_sources)
+    fields = a_template.fields + list(a_extra_fields)
+    if a_cache is not None:
+        fields = None
+    for item in compute_names_uncached(
+            files, a_template, a_header_only, a_jobs, a_chunk_size, fields):
+        key = keys.pop(item.fname, None)
+        if key is not None and item.meta is not None:
+            a_cache.put(key, item.meta)
+        yield item
+
+
+def compute_names_uncached(a_files, a_template, a_header_only, a_jobs,
+                           a_chunk_size, a_fields):
+    if a_jobs < 1:
+        a_jobs = multiprocessing.cpu_count()
+    if a_jobs == 1:
+        book = Book_fb2(a_header_only)
+        for fname, meta in a_files:
+            yield compute_name(book, fname, a_template, meta, a_fields)
+        return
+    pool = multiprocessing.Pool(
+        a_jobs, init_worker,
+        (a_template.format, a_header_only, a_fields, Common.sanitizer,
+         a_template.fallbacks, Book_fb2.limits))
+    try:
+        chunks = iter_chunks(a_files, a_chunk_size)
+        for items in ordered_imap(
+                pool, compute_names_worker, chunks, a_jobs * 2):
+            for item in items:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class DuplicateIndex(object):
+    modes = ['off', 'skip', 'link', 'report']
+    fields = ['doc_id', 'authors', 'title', 'sequences', 'lang']
+    block_size = 65536
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = {}
+        self.count = 0
+
+    @staticmethod
+    def normalize_id(a_id):
+        return ''.join(a_id.split()).strip('{}').lower()
+
+    @staticmethod
+    def get_meta_key(a_meta):
+        data = json.dumps(
+            [a_meta.authors, a_meta.title, a_meta.sequences, a_meta.lang],
+            sort_keys=True)
+        return hashlib.sha1(data).digest()
+
+    @staticmethod
+    def get_fingerprint(a_path, a_size):
+        digest = hashlib.sha1()
+        with open(a_path, 'rb') as f:
+            digest.update(f.read(DuplicateIndex.block_size))
+            if a_size > 2 * DuplicateIndex.block_size:
+                f.seek(-DuplicateIndex.block_size, os.SEEK_END)
+                digest.update(f.read(DuplicateIndex.block_size))
+            elif a_size > DuplicateIndex.block_size:
+                digest.update(f.read())
+        return digest.digest()
+
+    def find(self, a_item):
+        meta = a_item.meta
+        if meta.doc_id and meta.doc_id.strip():
+            key = (self.normalize_id(meta.doc_id), meta.title)
+            return self.ids.get(key)
+        for candidate in self.keys.get(self.get_meta_key(meta), []):
+            if candidate[1] != a_item.size:
+                continue
+            if candidate[2] is None:
+                candidate[2] = self.get_fingerprint(candidate[0], candidate[1])
+            if candidate[2] == self.get_fingerprint(a_item.fname, a_item.size):
+                return candidate[0]
+        return None
+
+    def add(self, a_item, a_path):
+        meta = a_item.meta
+        if meta.doc_id and meta.doc_id.strip():
+            key = (self.normalize_id(meta.doc_id), meta.title)
+            self.ids.setdefault(key, a_path)
+        else:
+            candidates = self.keys.setdefault(self.get_meta_key(meta), [])
+            candidates.append([a_path, a_item.size, None])
+
+
+class TargetIndex(object):
+    policies = ['suffix', 'skip', 'overwrite', 'fail']
+
+    def __init__(self, a_policy='suffix', a_case_insensitive=False,
+                 a_max_entries=0, a_max_bytes=255):
+        if a_policy not in self.policies:
+            raise Exception('No such collision policy: ' + a_policy)
+        self.policy = a_policy
+        self.case_insensitive = a_case_insensitive
+        self.max_entries = a_max_entries
+        self.max_bytes = a_max_bytes
+        self.dirs = {}
+        self.pages = {}
+        self.kept = set()
+        self.failed = None
+
+    def normalize(self, a_name):
+        if isinstance(a_name, str):
+            a_name = a_name.decode(
+                sys.getfilesystemencoding() or 'utf-8', 'replace')
+        if self.case_insensitive:
+            a_name = a_name.lower()
+        return a_name
+
+    def get_names(self, a_dir):
+        a_dir = os.path.abspath(a_dir)
+        names = self.dirs.get(a_dir)
+        if names is None:
+            try:
+                listing = os.listdir(a_dir)
+            except OSError:
+                listing = []
+            names = set(self.normalize(name) for name in listing)
+            self.dirs[a_dir] = names
+        return names
+
+    def is_same_path(self, a_src, a_dst):
+        return self.normalize(os.path.abspath(a_src)) == \
+            self.normalize(os.path.abspath(a_dst))
+
+    def is_same(self, a_src, a_dst):
+        if self.is_same_path(a_src, a_dst):
+            return True
+        if not os.path.lexists(a_dst):
+            return False
+        return self.normalize(os.path.realpath(a_src)) == \
+            self.normalize(os.path.realpath(a_dst))
+
+    def get_page(self, a_dir):
+        if not self.max_entries or \
+                len(self.get_names(a_dir)) < self.max_entries:
+            return a_dir
+        page = self.pages.get(a_dir, 1)
+        while len(self.get_names(
+                os.path.join(a_dir, '%04d' % page))) >= self.max_entries:
+            page += 1
+        self.pages[a_dir] = page
+        self.get_names(a_dir).add(self.normalize('%04d' % page))
+        return os.path.join(a_dir, '%04d' % page)
+
+    def claim(self, a_src, a_dst, a_policy=None):
+        policy = a_policy or self.policy
+        directory, name = os.path.split(a_dst)
+        same = self.is_same_path(a_src, a_dst)
+        if not same:
+            directory = self.get_page(directory)
+            a_dst = os.path.join(directory, name)
+        names = self.get_names(directory)
+        key = self.normalize(name)
+        if key in names and not same:
+            same = self.is_same(a_src, a_dst)
+        if same:
+            self.kept.add((a_src, a_dst))
+        if key not in names or same:
+            names.add(key)
+            return a_dst
+        if policy == 'overwrite':
+            return a_dst
+        if policy == 'skip':
+            return None
+        if policy == 'fail':
+            self.failed = a_dst
+            raise Exception('Target already exists: ' + a_dst)
+        base, ext = Common.split_extension(name)
+        for i in itertools.count(1):
+            name = Common.truncate_name(
+                base, u' (%d)%s' % (i, ext), self.max_bytes)
+            key = self.normalize(name)
+            if key not in names:
+                names.add(key)
+                return os.path.join(directory, name)
+
+    def is_kept(self, a_src, a_dst):
+        return (a_src, a_dst) in self.kept
+
+    def release(self, a_path):
+        directory, name = os.path.split(os.path.abspath(a_path))
+        names = self.dirs.get(directory)
+        if names is not None:
+            names.discard(self.normalize(name))
+
+
+class DirectoryCache(object):
+    group_size = 256
+
+    def __init__(self):
+        self.dirs = set()
+
+    def ensure(self, a_dir):
+        if not a_dir or a_dir in self.dirs:
+            return
+        try:
+            os.makedirs(a_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(a_dir):
+                raise
+        while a_dir and a_dir not in self.dirs:
+            self.dirs.add(a_dir)
+            a_dir = os.path.dirname(a_dir)
+
+    def ensure_all(self, a_dirs):
+        for directory in sorted(set(a_dirs)):
+            try:
+                self.ensure(directory)
+            except OSError:
+                pass
+
+    def prepare(self, a_items):
+        a_items = iter(a_items)
+        size = 1
+        while True:
+            group = list(itertools.islice(a_items, size))
+            if not group:
+                return
+            self.ensure_all(
+                os.path.dirname(item.target) for item in group
+                if item.error is None and item.target is not None)
+            for item in group:
+                yield item
+            size = min(size * 2, self.group_size)
+
+
+class Journal(object):
+    atomic_modes = ['link', 'reflink', 'copy', 'extract']
+
+    def __init__(self, a_path, a_resume=False, a_group_size=256,
+                 a_interval=1.0):
+        self.path = a_path
+        self.group_size = a_group_size
+        self.interval = a_interval
+        self.entries = collections.OrderedDict()
+        self.finished = set()
+        self.buffer = []
+        self.planned = set()
+        self.grouped = False
+        self.synced = default_timer()
+        size = 0
+        if os.path.exists(a_path):
+            if not a_resume:
+                raise Exception(
+                    'Journal already exists, use --resume or --undo: ' + a_path)
+            size = self.read(a_path)
+        self.file = open(a_path, 'ab')
+        self.file.truncate(size)
+        if a_resume:
+            self.recover()
+
+    def read(self, a_path):
+        size = 0
+        with open(a_path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                size += len(line)
+                key = (record['src'], record['dst'])
+                if record['op'] == 'plan':
+                    self.entries[key] = dict(record, done=False)
+                elif record['op'] == 'done':
+                    self.entries.setdefault(key, dict(record))['done'] = True
+                elif record['op'] == 'undone':
+                    self.entries.pop(key, None)
+        return size
+
+    @staticmethod
+    def get_inode(a_path):
+        try:
+            return os.stat(a_path).st_ino
+        except OSError:
+            return None
+
+    def is_done(self, a_entry):
+        if a_entry.get('done'):
+            return True
+        src, dst = a_entry['src'], a_entry['dst']
+        inode = self.get_inode(dst)
+        if inode is None or inode == a_entry.get('dst_ino'):
+            return False
+        if a_entry['mode'] == 'move':
+            return not os.path.exists(src)
+        return a_entry['mode'] in self.atomic_modes
+
+    def recover(self):
+        for entry in self.entries.values():
+            if self.is_done(entry):
+                entry['done'] = True
+                self.finished.add(entry['src'])
+                self.finished.add(entry['dst'])
+            elif os.path.exists(entry['dst'] + '.fb2rename'):
+                os.remove(entry['dst'] + '.fb2rename')
+
+    def is_finished(self, a_path):
+        return Catalog.get_path_key(a_path) in self.finished
+
+    def filter(self, a_files):
+        for fname in a_files:
+            if not self.is_finished(fname):
+                yield fname
+
+    def get_record(self, a_op, a_src, a_dst, a_mode, **a_fields):
+        record = {
+            'op': a_op, 'src': Catalog.get_path_key(a_src),
+            'dst': Catalog.get_path_key(a_dst), 'mode': a_mode}
+        record.update(a_fields)
+        return json.dumps(record, sort_keys=True) + '\n'
+
+    def plan(self, a_src, a_dst, a_mode):
+        key = (a_src, a_dst, a_mode)
+        if key in self.planned:
+            self.planned.discard(key)
+            return
+        self.buffer.append(self.get_record(
+            'plan', a_src, a_dst, a_mode, dst_ino=self.get_inode(a_dst)))
+        self.sync()
+
+    def plan_all(self, a_entries):
+        self.planned = set()
+        for src, dst, mode in a_entries:
+            self.buffer.append(self.get_record(
+                'plan', src, dst, mode, dst_ino=self.get_inode(dst)))
+            self.planned.add((src, dst, mode))
+        if self.planned:
+            self.sync()
+
+    def plan_groups(self, a_items, a_mode):
+        a_items = iter(a_items)
+        self.grouped = True
+        try:
+            while True:
+                group = list(itertools.islice(a_items, self.group_size))
+                if not group:
+                    return
+                self.plan_all(
+                    (item.fname, item.target, a_mode) for item in group
+                    if item.error is None and item.target is not None)
+                for item in group:
+                    yield item
+        finally:
+            self.grouped = False
+
+    def done(self, a_src, a_dst, a_mode, a_op='done'):
+        self.buffer.append(self.get_record(a_op, a_src, a_dst, a_mode))
+        if not self.grouped and len(self.buffer) >= self.group_size or \
+                default_timer() - self.synced >= self.interval:
+            self.sync()
+
+    def sync(self):
+        self.file.write(''.join(self.buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer = []
+        self.synced = default_timer()
+
+    def undo(self):
+        for entry in reversed(self.entries.values()):
+            src, dst, mode = entry['src'], entry['dst'], entry['mode']
+            item = RenameItem(dst)
+            if self.is_done(entry):
+                try:
+                    if mode == 'move':
+                        if os.path.exists(src):
+                            raise Exception('Source already exists: ' + src)
+                        Common.ensure_path_exists(os.path.dirname(src))
+                        FileOps.move(dst, src)
+                        item.name = item.target = src
+                    else:
+                        os.remove(dst)
+                    self.done(src, dst, mode, 'undone')
+                except:
+                    item.error = sys.exc_info()[1]
+            yield item
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def claim_target(a_targets, a_item):
+    a_item.base = a_item.target
+    target = a_targets.claim(a_item.fname, a_item.target)
+    if target is None:
+        a_item.skipped = a_item.target
+        a_item.target = None
+        return False
+    if target != a_item.target:
+        prefix = a_item.target[:len(a_item.target) - len(a_item.name)]
+        a_item.target = target
+        a_item.name = target[len(prefix):]
+    return True
+
+
+def quarantine(a_item, a_dir, a_dry_run, a_targets, a_dirs, a_journal):
+    a_item.name = os.path.basename(a_item.fname)
+    a_item.target = os.path.join(a_dir, a_item.name)
+    try:
+        if not claim_target(a_targets, a_item):
+            a_item.name = a_item.skipped = None
+            return
+        if not a_dry_run:
+            a_dirs.ensure(a_dir)
+            if a_journal is not None:
+                a_journal.plan(a_item.fname, a_item.target, 'move')
+            FileOps.move(a_item.fname, a_item.target)
+            if a_journal is not None:
+                a_journal.done(a_item.fname, a_item.target, 'move')
+        a_item.error = LimitError(
+            Common.get_error_text(a_item.error) + ', quarantined')
+    except:
+        a_item.name = a_item.target = None
+
+
+def rename_batch(a_paths, a_template, a_out_dir, a_dry_run=False,
+                 a_mode='move', a_header_only=True, a_jobs=1, a_cache=None,
+                 a_stats=None, a_dedup='off', a_targets=None, a_sources=(),
+                 a_journal=None, a_dirs=None, a_quarantine=None):
+    if not isinstance(a_template, NameTemplate):
+        a_template = NameTemplate(a_template)
+    a_template.validate()
+    if a_targets is None:
+        a_targets = TargetIndex()
+    index = None
+    extra_fields = []
+    if a_dedup != 'off':
+        index = DuplicateIndex()
+        extra_fields = DuplicateIndex.fields
+    if a_dirs is None:
+        a_dirs = DirectoryCache()
+
+    def claim(a_item):
+        if a_item.target is None and a_item.skipped is None:
+            a_item.target = os.path.join(a_out_dir, a_item.name)
+            claim_target(a_targets, a_item)
+        return a_item.target is not None
+
+    def claim_all(a_items):
+        for item in a_items:
+            if item.error is None:
+                try:
+                    claim(item)
+                except:
+                    item.error = sys.exc_info()[1]
+            yield item
+            if a_targets.failed is not None:
+                return
+
+    items = compute_names(
+        a_paths, a_template, a_header_only, a_jobs, a_cache=a_cache,
+        a_extra_fields=extra_fields, a_sources=a_sources)
+    if not a_dry_run and a_dedup in ('off', 'report'):
+        items = a_dirs.prepare(claim_all(items))
+        if a_journal is not None:
+            items = a_journal.plan_groups(items, a_mode)
+    for item in items:
+        rename_time = 0.0
+        if a_quarantine and isinstance(item.error, LimitError):
+            quarantine(
+                item, a_quarantine, a_dry_run, a_targets, a_dirs, a_journal)
+        if item.error is None:
+            start = default_timer()
+            try:
+                if index is not None:
+                    item.duplicate = index.find(item)
+                if item.duplicate is not None and a_dedup != 'report':
+                    item.target = None
+                    if a_dedup == 'link' and not a_dry_run:
+                        FileOps.link(item.duplicate, item.fname)
+                elif claim(item) and \
+                        not a_targets.is_kept(item.fname, item.target):
+                    if not a_dry_run:
+                        a_dirs.ensure(os.path.dirname(item.target))
+                        if a_journal is not None:
+                            a_journal.plan(item.fname, item.target, a_mode)
+                        FileOps.apply(a_mode, item.fname, item.target)
+                        if a_journal is not None:
+                            a_journal.done(item.fname, item.target, a_mode)
+                    if a_mode == 'move':
+                        a_targets.release(item.fname)
+                if index is not None and item.duplicate is None and \
+                        item.skipped is None:
+                    path = item.fname
+                    if not a_dry_run:
+                        path = item.target
+                    index.add(item, path)
+            except:
+                item.error = sys.exc_info()[1]
+            rename_time = default_timer() - start
+        if a_stats is not None:
+            a_stats.add(item, rename_time)
+        yield item
+        if a_targets.failed is not None:
+            return
+
+
+def rename_archive(a_path, a_template, a_out_dir, a_dry_run=False,
+                   a_output='files', a_header_only=True, a_stats=None,
+                   a_targets=None, a_sources=(), a_journal=None,
+                   a_dirs=None):
+    if a_output not in LibraryArchive.outputs:
+        raise Exception('No such archive output: ' + a_output)
+    if not isinstance(a_template, NameTemplate):
+        a_template = NameTemplate(a_template)
+    a_template.validate()
+    if a_targets is None:
+        a_targets = TargetIndex()
+    if a_dirs is None:
+        a_dirs = DirectoryCache()
+    archive = LibraryArchive(a_path)
+    book = Book_fb2_member(archive, a_header_only)
+    dest = None
+
+    def keep(a_info):
+        name = a_targets.claim(
+            a_path, os.path.join(repack, a_info.filename), 'suffix')
+        if dest is not None:
+            archive.copy_raw(a_info, dest, name[len(repack) + 1:])
+
+    try:
+        if a_output == 'repack':
+            repack = a_targets.claim(
+                a_path, os.path.join(a_out_dir, os.path.basename(a_path)))
+            if repack is None:
+                raise IOError(errno.EEXIST, 'Target already exists', a_path)
+            if a_targets.is_same(a_path, repack):
+                raise IOError(
+                    errno.EEXIST, 'Repacked archive would replace its source, '
+                    'use another output directory', a_path)
+            if not a_dry_run:
+                dest = zipfile.ZipFile(
+                    repack + '.fb2rename', 'w', allowZip64=True)
+            for info in archive.others:
+                keep(info)
+        files = archive.members
+        if a_journal is not None and a_output != 'repack':
+            files = a_journal.filter(files)
+        files = lookup_cached(files, None, {}, a_sources)
+        for fname, meta in files:
+            item = compute_name(book, fname, a_template, meta, a_template.fields)
+            rename_time = 0.0
+            if item.error is None:
+                start = default_timer()
+                info = archive.members[fname]
+                try:
+                    if a_output == 'repack':
+                        item.target = os.path.join(repack, item.name)
+                        if claim_target(a_targets, item) and \
+                                dest is not None:
+                            archive.copy_raw(info, dest, item.name)
+                    else:
+                        if a_output == 'zip':
+                            item.name += '.zip'
+                        item.target = os.path.join(a_out_dir, item.name)
+                        if claim_target(a_targets, item) and not a_dry_run:
+                            a_dirs.ensure(os.path.dirname(item.target))
+                            if a_journal is not None:
+                                a_journal.plan(
+                                    item.fname, item.target, 'extract')
+                            if a_output == 'zip':
+                                archive.pack(
+                                    info, item.target,
+                                    os.path.basename(item.name)[:-4])
+                            else:
+                                archive.extract(info, item.target)
+                            if a_journal is not None:
+                                a_journal.done(
+                                    item.fname, item.target, 'extract')
+                except:
+                    item.error = sys.exc_info()[1]
+                rename_time = default_timer() - start
+            if a_output == 'repack' and (
+                    item.error is not None or item.skipped is not None):
+                keep(archive.members[fname])
+            if a_stats is not None:
+                a_stats.add(item, rename_time)
+            yield item
+            if a_targets.failed is not None:
+                return
+        if dest is not None:
+            dest.close()
+            os.rename(dest.filename, repack)
+            dest = None
+    finally:
+        if dest is not None:
+            dest.close()
+            os.remove(dest.filename)
+        archive.close()
+
+
+class DirEntry(object):
+    __slots__ = ('name', 'path', 'lstat')
+
+    def __init__(self, a_dir, a_name):
+        self.name = a_name
+        self.path = os.path.join(a_dir, a_name)
+        self.lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self.lstat is None:
+            self.lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self.lstat.st_mode):
+            return os.stat(self.path)
+        return self.lstat
+
+    def inode(self):
+        return self.stat(False).st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def list_dir(a_dir):
+    if scandir is not None:
+        return scandir(a_dir)
+    return (DirEntry(a_dir, name) for name in os.listdir(a_dir))
+
+
+def iter_files_to_work_with(a_files=[], a_types=[], a_path=[], a_recursive=False):
+    if not isinstance(a_types, list) or not a_types:
+        return
+    if not isinstance(a_path, list):
+        return
+    extensions = set(a_types)
+    depth = max(ext.count('.') for ext in extensions) + 1
+    seen = set()
+
+    def matches(a_name):
+        parts = a_name.rsplit('.', depth)
+        for i in range(len(parts) - 1, 0, -1):
+            if '.'.join(parts[i:]) in extensions:
+                return True
+        return False
+
+    def is_new(a_key):
+        if a_key in seen:
+            return False
+        seen.add(a_key)
+        return True
+
+    for f in a_files:
+        f = os.path.abspath(f)
+        if not matches(os.path.basename(f)):
+            continue
+        try:
+            st = os.lstat(f)
+            key = (st.st_dev, st.st_ino)
+        except OSError:
+            key = f
+        if is_new(key):
+            yield f
+
+    paths = a_path
+    if not a_files and not a_path:
+        paths = [os.getcwd()]
+    for p in paths:
+        if not os.path.isdir(p):
+            continue
+        dirs = [os.path.abspath(p)]
+        while dirs:
+            curr_dir = dirs.pop()
+            try:
+                dev = os.stat(curr_dir).st_dev
+                entries = list_dir(curr_dir)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                if a_recursive and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif matches(entry.name) and entry.is_file() and \
+                        is_new((dev, entry.inode())):
+                    yield entry.path
+            dirs.extend(reversed(subdirs))
+
+
+class Inotify(object):
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_CLOEXEC = 0o2000000
+    event_header = struct.Struct('iIII')
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(
+                ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(Inotify.libc, 'inotify_init1'):
+            raise Exception('inotify is not supported on this platform')
+        self.fd = Inotify.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            Inotify.raise_errno()
+        self.watches = {}
+
+    @staticmethod
+    def raise_errno():
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+    def add_watch(self, a_path, a_mask):
+        path = a_path
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = Inotify.libc.inotify_add_watch(self.fd, path, a_mask)
+        if wd < 0:
+            Inotify.raise_errno()
+        self.watches[wd] = a_path
+        return wd
+
+    @staticmethod
+    def parse_events(a_data):
+        events = []
+        pos = 0
+        size = Inotify.event_header.size
+        while pos + size <= len(a_data):
+            wd, mask, cookie, length = \
+                Inotify.event_header.unpack_from(a_data, pos)
+            pos += size
+            name = a_data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def read(self, a_timeout=None):
+        ready = select.select([self.fd], [], [], a_timeout)[0]
+        if not ready:
+            return []
+        return self.parse_events(os.read(self.fd, 65536))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+
+    def __init__(self, a_dir, a_types, a_settle=2.0):
+        self.dir = os.path.abspath(a_dir)
+        self.types = a_types
+        self.settle = a_settle
+        self.pending = {}
+        self.processed = set()
+        self.inotify = Inotify()
+        self.inotify.add_watch(
+            self.dir, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+        self.scan()
+
+    def scan(self):
+        for path in iter_files_to_work_with([], self.types, [self.dir]):
+            self.add(path)
+
+    def add(self, a_path):
+        try:
+            st = os.stat(a_path)
+        except OSError:
+            self.pending.pop(a_path, None)
+            return
+        if (st.st_dev, st.st_ino) in self.processed:
+            return
+        self.pending[a_path] = (
+            default_timer(), (st.st_size, st.st_mtime))
+
+    def poll(self):
+        timeout = None
+        if self.pending:
+            oldest = min(t for t, sig in self.pending.values())
+            timeout = max(0.0, oldest + self.settle - default_timer())
+        for wd, mask, cookie, name in self.inotify.read(timeout):
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.scan()
+            elif name:
+                path = os.path.join(self.dir, name)
+                for found in iter_files_to_work_with([path], self.types, []):
+                    self.add(found)
+        now = default_timer()
+        batch = []
+        for path, (changed, signature) in self.pending.items():
+            if now - changed < self.settle:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (st.st_size, st.st_mtime) != signature:
+                self.pending[path] = (now, (st.st_size, st.st_mtime))
+                continue
+            del self.pending[path]
+            self.processed.add((st.st_dev, st.st_ino))
+            batch.append(path)
+        return sorted(batch)
+
+    def retry(self, a_paths):
+        for path in a_paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self.processed.discard((st.st_dev, st.st_ino))
+            self.add(path)
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_files_to_work_with(a_files=[], a_types=[], a_path=[], a_recursive=False):
+    return list(iter_files_to_work_with(a_files, a_types, a_path, a_recursive))
+
+
+class Shard(object):
+
+    def __init__(self, a_index, a_count):
+        if a_count < 1 or not 0 <= a_index < a_count:
+            raise Exception('Bad shard %d/%d' % (a_index, a_count))
+        self.index = a_index
+        self.count = a_count
+
+    @staticmethod
+    def parse(a_value):
+        try:
+            index, count = [int(v) for v in a_value.split('/')]
+        except ValueError:
+            raise Exception('Bad shard, expected I/N: ' + a_value)
+        return Shard(index, count)
+
+    @staticmethod
+    def get_relative_path(a_path, a_roots):
+        path = os.path.abspath(a_path)
+        for root in sorted((os.path.abspath(r) for r in a_roots), key=len,
+                           reverse=True):
+            if path.startswith(os.path.join(root, '')):
+                break
+        else:
+            root = os.getcwd()
+        path = os.path.relpath(path, root).replace(os.sep, '/')
+        if isinstance(path, str):
+            path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+        return path
+
+    def get_shard(self, a_path, a_roots=()):
+        path = self.get_relative_path(a_path, a_roots)
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % self.count
+
+    def filter(self, a_files, a_roots=()):
+        for fname in a_files:
+            if self.get_shard(fname, a_roots) == self.index:
+                yield fname
+
+
+def read_plan(a_path):
+    with open(a_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def merge_plans(a_plans, a_targets):
+    merged = collections.OrderedDict()
+    collisions = []
+    errors = []
+    for path in a_plans:
+        records = []
+        for record in read_plan(path):
+            records.append(record)
+            if record.get('error'):
+                errors.append((path, record.get('old'), record['error']))
+                continue
+            if not record.get('new'):
+                continue
+            base = record.get('base') or record['new']
+            item = RenameItem(record['old'], base)
+            item.target = base
+            try:
+                claim_target(a_targets, item)
+            except:
+                item.error = sys.exc_info()[1]
+            if item.error is not None or item.target != record['new']:
+                collisions.append((path, record['old'], record['new']))
+            if item.error is not None:
+                record['error'] = Common.get_error_text(item.error)
+                record['new'] = None
+                errors.append((path, record['old'], record['error']))
+            else:
+                record['new'] = item.target
+            if a_targets.failed is not None:
+                return merged, collisions, errors
+        merged[path] = records
+    return merged, collisions, errors
+
+
+def apply_plan(a_records, a_mode='move', a_dry_run=False, a_stats=None,
+               a_targets=None, a_journal=None, a_dirs=None):
+    if a_targets is None:
+        a_targets = TargetIndex()
+    if a_dirs is None:
+        a_dirs = DirectoryCache()
+
+    def claim_all(a_records):
+        for record in a_records:
+            if record.get('error') or not record.get('old') or \
+                    not record.get('new'):
+                continue
+            item = RenameItem(record['old'], record['new'])
+            item.target = record['new']
+            try:
+                item.size = os.path.getsize(item.fname)
+                claim_target(a_targets, item)
+            except:
+                item.error = sys.exc_info()[1]
+            yield item
+            if a_targets.failed is not None:
+                return
+
+    items = claim_all(a_records)
+    if a_journal is not None and not a_dry_run:
+        items = a_journal.plan_groups(items, a_mode)
+    for item in items:
+        start = default_timer()
+        try:
+            if item.error is None and item.target is not None and \
+                    not a_targets.is_kept(item.fname, item.target):
+                if not a_dry_run:
+                    a_dirs.ensure(os.path.dirname(item.target))
+                    if a_journal is not None:
+                        a_journal.plan(item.fname, item.target, a_mode)
+                    FileOps.apply(a_mode, item.fname, item.target)
+                    if a_journal is not None:
+                        a_journal.done(item.fname, item.target, a_mode)
+                if a_mode == 'move':
+                    a_targets.release(item.fname)
+        except:
+            item.error = sys.exc_info()[1]
+        if a_stats is not None:
+            a_stats.add(item, default_timer() - start)
+        yield item
+        if a_targets.failed is not None:
+            return
+
+
+def manage_cmd():
+    parser = argparse.ArgumentParser(
+        description='Renames given fb2, fb2.zip or fb2.gz files using pattern.',
+        epilog='Start with --index to write a catalog of books or with '
+        '--merge to combine shard plans; add -h after it for their options.')
+    parser.add_argument(
+        'fname', metavar='fb2_file_names', type=str, nargs='*',
+        help='name of the files to rename')
+    parser.add_argument(
+        '--format', '-f', dest='format', action='store',
+        help='Format of the new name. Possble values are: ' +
+        ', '.join(Common.get_format_patterns()) + '.\n' +
+        'Author name could be #F/M/L like #First/Middle/Last name.'
+    )
+    parser.add_argument(
+        '--template', '-t', metavar='template', action='store',
+        default='default',
+        help='Predefined formats. Possble value are: ' +
+        ', '.join(Common.get_templates()) + '.'
+    )
+    parser.add_argument(
+        '--fallback', dest='fallbacks', action='append', default=[],
+        metavar='FIELD=FIELD,...',
+        help='Fields tried in order when a field is missing, e.g. '
+        'title=bookname,oldname. An empty list disables the fallback. '
+        'Defaults: ' + '; '.join(
+            f + '=' + ','.join(c) for f, c in sorted(BookMeta.fallbacks.items())
+        ) + '.')
+    parser.add_argument(
+        '--max-read', dest='max_read', type=int, action='store', default=0,
+        help='Stop parsing a book after this many uncompressed MB and report '
+        'it. 0 means no limit.')
+    parser.add_argument(
+        '--max-header', dest='max_header', type=int, action='store',
+        default=0,
+        help='Stop reading a book header after this many KB and report the '
+        'book. 0 means no limit.')
+    parser.add_argument(
+        '--max-parse-time', dest='max_parse_time', type=float,
+        action='store', default=0,
+        help='Stop parsing a book after this many seconds and report it. '
+        '0 means no limit.')
+    parser.add_argument(
+        '--quarantine', dest='quarantine', action='store', default='',
+        help='Move books exceeding a limit into this directory.')
+    parser.add_argument(
+        '--dry-run', '-d', dest='dryrun', action='store_true',
+        default=False,
+        help='Do not rename files. Just show new names.')
+    parser.add_argument(
+        '--recursive', '-r', dest='recursive', type=bool, action='store',
+        default=False,
+        help='Scan given directories recursively.'
+    )
+    parser.add_argument(
+        '-o', dest='out_dir', action='store',
+        default='',
+        help='Output directory')
+    parser.add_argument(
+        '--mode', '-m', dest='mode', action='store',
+        choices=FileOps.modes, default='move',
+        help='How books get their new names: move them, hardlink them, '
+        'clone them with a reflink (btrfs, XFS) or copy them in the kernel. '
+        'Default is %(default)s.')
+    parser.add_argument(
+        '--full-parse', dest='full_parse', action='store_true',
+        default=False,
+        help='Parse whole files instead of stopping after <description>.')
+    parser.add_argument(
+        '--jobs', '-j', dest='jobs', type=int, action='store',
+        default=1,
+        help='Number of worker processes used to parse books. '
+        '0 means one per CPU.')
+    parser.add_argument(
+        '--io-threads', dest='io_threads', type=int, action='store',
+        default=0,
+        help='Number of threads reading book headers ahead of the parser. '
+        'Useful on network and spinning storage. 0 disables readahead.')
+    parser.add_argument(
+        '--readahead-depth', dest='readahead_depth', type=int,
+        action='store', default=64,
+        help='Maximum number of files read ahead of the parser.')
+    parser.add_argument(
+        '--readahead-size', dest='readahead_size', type=int,
+        action='store', default=64,
+        help='Kilobytes read ahead from the start of each file.')
+    parser.add_argument(
+        '--cache', dest='cache', action='store', nargs='?', default='',
+        const=MetaCache.get_default_path(),
+        help='Keep extracted metadata in this cache file so that unchanged '
+        'books are not parsed again. Without a file name %(const)s is used. '
+        'Off by default.')
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_const', const='',
+        help='Do not use the metadata cache.')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=int, action='store',
+        default=1000000,
+        help='Maximum number of books kept in the metadata cache.')
+    parser.add_argument(
+        '--catalog', dest='catalog', action='store', default='',
+        help='Catalog written by --index. Books unchanged since '
+        'indexing are renamed without parsing.')
+    parser.add_argument(
+        '--archive-output', dest='archive_output', action='store',
+        choices=LibraryArchive.outputs, default='files',
+        help='How books from multi-book .zip archives are written to the '
+        'output directory: as loose files, one .fb2.zip per book or a '
+        'repacked archive with renamed members.')
+    parser.add_argument(
+        '--inpx', dest='inpx', action='store', default='',
+        help='INPX library index to take book metadata from. Books missing '
+        'from the index are parsed.')
+    parser.add_argument(
+        '--fs', dest='filesystem', action='store',
+        choices=sorted(Sanitizer.filesystems), default='default',
+        help='Replace characters reserved on this target filesystem.')
+    parser.add_argument(
+        '--translit', dest='translit', action='store_true',
+        default=False,
+        help='Transliterate Cyrillic letters to Latin.')
+    parser.add_argument(
+        '--max-bytes', dest='max_bytes', type=int, action='store',
+        default=255,
+        help='Truncate each part of the new name to this many UTF-8 bytes. '
+        'Default is %(default)s.')
+    parser.add_argument(
+        '--on-collision', dest='on_collision', action='store',
+        choices=TargetIndex.policies, default='suffix',
+        help='What to do when the new name is already taken: add a " (N)" '
+        'suffix, skip the book, overwrite the target or stop the run. '
+        'Default is %(default)s.')
+    parser.add_argument(
+        '--max-per-dir', dest='max_per_dir', type=int, action='store',
+        default=0,
+        help='Maximum number of entries in an output directory. Further books '
+        'go to numbered subdirectories 0001, 0002 and so on.')
+    parser.add_argument(
+        '--case-insensitive', dest='case_insensitive', action='store_true',
+        default=False,
+        help='Treat names differing only in case as the same, as on FAT and '
+        'exFAT.')
+    parser.add_argument(
+        '--dedup', dest='dedup', action='store',
+        choices=DuplicateIndex.modes, default='off',
+        help='What to do with copies of an already renamed book: skip them, '
+        'replace them with hardlinks to the kept copy or only report them.')
+    parser.add_argument(
+        '--journal', dest='journal', action='store', default='',
+        help='Record planned and finished renames in this file so that an '
+        'interrupted run can be resumed or undone.')
+    parser.add_argument(
+        '--journal-group', dest='journal_group', type=int, action='store',
+        default=256,
+        help='Number of renames planned in the journal per fsync. Their '
+        'plans are fsynced before the first of them happens; books checked '
+        'with --dedup skip or link are planned one at a time.')
+    parser.add_argument(
+        '--resume', dest='resume', action='store_true', default=False,
+        help='Continue the run recorded in --journal, skipping books it '
+        'already renamed.')
+    parser.add_argument(
+        '--undo', dest='undo', action='store_true', default=False,
+        help='Revert the renames recorded in --journal and exit.')
+    parser.add_argument(
+        '--shard', dest='shard', action='store', default='',
+        help='Process only shard I of N (0 <= I < N), chosen by a stable hash '
+        'of the path relative to the current directory. Run a dry run with '
+        '--output jsonl on every node and combine the plans with --merge.')
+    parser.add_argument(
+        '--plan', dest='plan', action='store', default='',
+        help='Rename books as listed in a plan written by --merge instead of '
+        'parsing them.')
+    parser.add_argument(
+        '--order', dest='order', action='store',
+        choices=Scheduler.orders, default='none',
+        help='Order in which books are read: as discovered, by path, by '
+        'inode number or by physical position on disk (FIEMAP, Linux). '
+        'Default is %(default)s.')
+    parser.add_argument(
+        '--order-window', dest='order_window', type=int, action='store',
+        default=10000,
+        help='Number of discovered books reordered at once. A window is '
+        'fully discovered before its first book is renamed; 0 reorders the '
+        'whole input. Default is %(default)s.')
+    parser.add_argument(
+        '--watch', dest='watch', action='store',
+        default='',
+        help='Keep running and rename books as they appear in this '
+        'directory (Linux only).')
+    parser.add_argument(
+        '--settle', dest='settle', type=float, action='store',
+        default=2.0,
+        help='Seconds a watched file must stay unchanged before it is '
+        'renamed. Default is %(default)s.')
+    parser.add_argument(
+        '--output', dest='output', action='store',
+        choices=['text', 'jsonl'], default='text',
+        help='Print "old => new" lines or one JSON object per book.')
+    parser.add_argument(
+        '--stats', dest='stats', action='store_true',
+        default=False,
+        help='Print per-phase timings, throughput and latencies at the end.')
+    parser.add_argument(
+        '--stats-json', dest='stats_json', action='store',
+        default='',
+        help='Write the same statistics as JSON to this file.')
+    parser.add_argument(
+        '--slowest', dest='slowest', type=int, action='store',
+        default=10,
+        help='Number of slowest files reported in statistics.')
+    parser.add_argument(
+        '--progress', dest='progress', type=float, action='store',
+        default=0,
+        help='Print a progress line to stderr every given number of seconds.')
+    args = parser.parse_args()
+    return args
+
+
+def manage_index_cmd():
+    parser = argparse.ArgumentParser(
+        prog='fb2rename.py --index',
+        description='Writes a catalog of given fb2, fb2.zip or fb2.gz files. '
+        'Unchanged files already in the catalog are skipped.')
+    parser.add_argument(
+        'fname', metavar='fb2_file_names', type=str, nargs='*',
+        help='name of the files or directories to index')
+    parser.add_argument(
+        '--catalog', '-c', dest='catalog', action='store', required=True,
+        help='SQLite catalog file, or CSV if the name ends with .csv.')
+    parser.add_argument(
+        '--recursive', '-r', dest='recursive', action='store_true',
+        default=False,
+        help='Index directories recursively.')
+    parser.add_argument(
+        '--jobs', '-j', dest='jobs', type=int, action='store',
+        default=1,
+        help='Number of processes parsing books in parallel.')
+    parser.add_argument(
+        '--full-parse', dest='full_parse', action='store_true',
+        default=False,
+        help='Parse whole books instead of only their headers.')
+    parser.add_argument(
+        '--prune', dest='prune', action='store_true',
+        default=False,
+        help='Remove catalog entries of books that were not seen.')
+    return parser.parse_args(sys.argv[2:])
+
+
+def manage_merge_cmd():
+    parser = argparse.ArgumentParser(
+        prog='fb2rename.py --merge',
+        description='Combines per-shard plans written by dry runs with '
+        '--output jsonl, reports errors and resolves target collisions '
+        'between shards. Writes a .merged.jsonl file next to every plan.')
+    parser.add_argument(
+        'plans', metavar='plan', type=str, nargs='+',
+        help='plan files of all shards, in a fixed order')
+    parser.add_argument(
+        '--on-collision', dest='on_collision', action='store',
+        choices=TargetIndex.policies, default='suffix',
+        help='What to do when shards chose the same target. Default is '
+        '%(default)s.')
+    parser.add_argument(
+        '--case-insensitive', dest='case_insensitive', action='store_true',
+        default=False,
+        help='Treat targets differing only in case as the same name.')
+    return parser.parse_args(sys.argv[2:])
+
+
+def merge_main():
+    args = manage_merge_cmd()
+    targets = TargetIndex(args.on_collision, args.case_insensitive)
+    try:
+        merged, collisions, errors = merge_plans(args.plans, targets)
+    except (IOError, ValueError):
+        print 'Errors: '
+        print ' ', sys.exc_info()[1]
+        return
+    if targets.failed is None:
+        for path, records in merged.items():
+            base = path
+            if base.endswith('.jsonl'):
+                base = base[:-len('.jsonl')]
+            with open(base + '.merged.jsonl', 'wb') as f:
+                for record in records:
+                    line = json.dumps(record, sort_keys=True)
+                    f.write(line + '\n')
+    print 'Plans: %d, collisions: %d, errors: %d' % (
+        len(args.plans), len(collisions), len(errors))
+    if collisions:
+        print 'Collisions: '
+        for path, old, new in collisions:
+            print '  ' + path + ': ' + old + ' => ' + new
+    print 'Errors: '
+    for path, old, error in errors:
+        print '  ' + path + ': ' + (old or '') + ':', error
+
+
+def index_main():
+    args = manage_index_cmd()
+    errors = {}
+    try:
+        catalog = Catalog.open(args.catalog)
+    except (sqlite3.Error, IOError, OSError, csv.Error):
+        print 'Errors: '
+        print '  ' + args.catalog + ':', sys.exc_info()[1]
+        return
+    indexed = 0
+    dirs = [f for f in args.fname if os.path.isdir(f)]
+    input_files = iter_files_to_work_with(
+        [f for f in args.fname if f not in dirs], Book_fb2.extensions,
+        dirs, args.recursive)
+    for item in index_books(
+            input_files, catalog, not args.full_parse, args.jobs):
+        if item.error is not None:
+            errors[item.fname] = item.error
+        else:
+            indexed += 1
+    removed = 0
+    if args.prune:
+        removed = catalog.prune()
+    catalog.close()
+    print 'Indexed: %d, removed: %d' % (indexed, removed)
+    print 'Errors: '
+    for e in errors:
+        print '  ' + e + ':', errors[e]
+
+
+def print_json(a_record):
+    line = json.dumps(a_record, ensure_ascii=False, sort_keys=True)
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def print_items(a_items, a_errors, a_duplicates, a_skipped, a_jsonl,
+                a_seen=None):
+    for item in a_items:
+        if a_seen is not None:
+            a_seen.add(item.fname)
+        if a_jsonl:
+            print_json(item.to_dict())
+            continue
+        if item.duplicate is not None:
+            a_duplicates[item.fname] = item.duplicate
+        if item.skipped is not None:
+            a_skipped[item.fname] = item.skipped
+        if item.target is not None:
+            print item.fname, ' => ', item.name
+        if item.error is not None:
+            a_errors[item.fname] = item.error
+    sys.stdout.flush()
+
+
+def print_summary(a_errors, a_duplicates, a_skipped, a_jsonl):
+    if a_jsonl:
+        for e in a_errors:
+            print_json({
+                'old': None, 'new': None, 'fields': None,
+                'error': Common.decode_path(e) + ': ' +
+                Common.get_error_text(a_errors[e])})
+        return
+    if a_duplicates:
+        print 'Duplicates: '
+        for d in a_duplicates:
+            print ' ', d, '==', a_duplicates[d]
+    if a_skipped:
+        print 'Skipped: '
+        for d in a_skipped:
+            print ' ', d, '=>', a_skipped[d], 'already exists'
+    print 'Errors: '
+    for e in a_errors:
+        print '  ' + e + ':', a_errors[e]
+    sys.stdout.flush()
+
+
+def main():
+    if sys.argv[1:2] == ['--index']:
+        index_main()
+        return
+    if sys.argv[1:2] == ['--merge']:
+        merge_main()
+        return
+    args = manage_cmd()
+    errors = {}
+    duplicates = {}
+    skipped = {}
+    jsonl = args.output == 'jsonl'
+    if args.out_dir and os.path.isdir(args.out_dir):
+        out_dir = args.out_dir
+    else:
+        out_dir = os.getcwd()
+    Common.sanitizer = Sanitizer(
+        args.filesystem, args.translit, args.max_bytes)
+    Book_fb2.limits = ParseLimits(
+        args.max_read << 20, args.max_header << 10, args.max_parse_time)
+    if args.undo:
+        if not args.journal:
+            errors['undo'] = 'There is no --journal to undo'
+        else:
+            try:
+                journal = Journal(args.journal, True, args.journal_group)
+                try:
+                    print_items(
+                        journal.undo(), errors, duplicates, skipped, jsonl)
+                finally:
+                    journal.close()
+            except (IOError, OSError):
+                errors['journal'] = sys.exc_info()[1]
+        print_summary(errors, duplicates, skipped, jsonl)
+        return
+    templates = Common.get_templates()
+    name_format = None
+    stats = None
+    fallbacks = None
+    try:
+        fallbacks = BookMeta.get_fallbacks(args.fallbacks)
+    except:
+        errors['fallback'] = sys.exc_info()[1]
+    if args.template not in templates:
+        errors['template'] = 'No such template: ' + args.template
+    elif fallbacks is not None:
+        name_format = templates[args.template]
+        if args.format:
+            name_format = args.format
+        name_format = NameTemplate(name_format, fallbacks)
+        try:
+            name_format.validate()
+        except:
+            errors['template'] = sys.exc_info()[1]
+            name_format = None
+    shard = None
+    if name_format is not None and args.shard:
+        try:
+            shard = Shard.parse(args.shard)
+        except:
+            errors['shard'] = sys.exc_info()[1]
+            name_format = None
+    journal = None
+    if name_format is not None and args.journal and not args.dryrun:
+        try:
+            journal = Journal(args.journal, args.resume, args.journal_group)
+        except:
+            errors['journal'] = sys.exc_info()[1]
+            name_format = None
+    if name_format is not None:
+        cache = None
+        if args.cache:
+            try:
+                cache = MetaCache(args.cache, args.cache_size)
+            except (sqlite3.Error, OSError):
+                errors['cache'] = sys.exc_info()[1]
+        sources = []
+        if args.catalog:
+            try:
+                sources.append(Catalog.open(args.catalog))
+            except (sqlite3.Error, IOError, OSError, csv.Error):
+                errors['catalog'] = sys.exc_info()[1]
+        if args.inpx:
+            try:
+                sources.append(Book_inpx(args.inpx))
+            except (zipfile.BadZipfile, IOError, OSError, UnicodeError):
+                errors['inpx'] = sys.exc_info()[1]
+        if args.stats or args.stats_json or args.progress:
+            stats = RunStats(args.slowest, args.progress)
+
+        prefetcher = None
+        if args.io_threads > 0:
+            prefetcher = Prefetcher(
+                args.io_threads, args.readahead_depth,
+                args.readahead_size * 1024)
+
+        scheduler = Scheduler(args.order, args.order_window)
+        targets = TargetIndex(
+            args.on_collision, args.case_insensitive, args.max_per_dir,
+            args.max_bytes)
+        dirs = DirectoryCache()
+
+        def rename(a_files, a_seen=None):
+            if prefetcher is not None:
+                a_files = prefetcher.iter(a_files)
+            items = rename_batch(
+                a_files, name_format, out_dir, args.dryrun, args.mode,
+                not args.full_parse, args.jobs, cache, stats, args.dedup,
+                targets, sources, journal, dirs, args.quarantine)
+            print_items(items, errors, duplicates, skipped, jsonl, a_seen)
+
+        if args.watch:
+            try:
+                watcher = Watcher(
+                    args.watch, Book_fb2.extensions, args.settle)
+            except:
+                errors['watch'] = sys.exc_info()[1]
+                watcher = None
+            try:
+                while watcher is not None:
+                    files = watcher.poll()
+                    if not files:
+                        continue
+                    targets.failed = None
+                    seen = set()
+                    rename(scheduler.iter(files, stats), seen)
+                    watcher.retry(f for f in files if f not in seen)
+                    if cache is not None:
+                        cache.commit()
+                    if journal is not None:
+                        journal.sync()
+                    if errors or duplicates or skipped:
+                        print_summary(errors, duplicates, skipped, jsonl)
+                        errors.clear()
+                        duplicates.clear()
+                        skipped.clear()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if watcher is not None:
+                    watcher.close()
+        elif args.plan:
+            items = apply_plan(
+                read_plan(args.plan), args.mode, args.dryrun, stats, targets,
+                journal, dirs)
+            try:
+                print_items(items, errors, duplicates, skipped, jsonl)
+            except (IOError, ValueError):
+                errors['plan'] = sys.exc_info()[1]
+        else:
+            archives = [f for f in args.fname if LibraryArchive.is_archive(f)]
+            input_files = iter_files_to_work_with(
+                [f for f in args.fname if f not in archives],
+                Book_fb2.extensions, a_recursive=args.recursive)
+            if journal is not None and args.resume:
+                input_files = journal.filter(input_files)
+            if shard is not None:
+                input_files = shard.filter(input_files)
+                archives = list(shard.filter(archives))
+            if stats is not None:
+                input_files = stats.timed('discovery', input_files)
+            rename(scheduler.iter(input_files, stats))
+            for path in archives:
+                if targets.failed is not None:
+                    break
+                items = rename_archive(
+                    path, name_format, out_dir, args.dryrun,
+                    args.archive_output, not args.full_parse, stats, targets,
+                    sources, journal, dirs)
+                try:
+                    print_items(items, errors, duplicates, skipped, jsonl)
+                except (zipfile.BadZipfile, IOError, OSError):
+                    errors[path] = sys.exc_info()[1]
+        if cache is not None:
+            cache.close()
+        for source in sources:
+            source.close()
+        if journal is not None:
+            journal.close()
+
+    print_summary(errors, duplicates, skipped, jsonl)
+    if stats is not None:
+        if args.stats:
+            for line in stats.format_summary():
+                if jsonl:
+                    sys.stderr.write(line + '\n')
+                else:
+                    print line
+        if args.stats_json:
+            with open(args.stats_json, 'w') as f:
+                json.dump(stats.get_summary(), f, indent=2)
 
 
 if __name__ == '__main__':
@@ -6,6 +6,10 @@ import shutil
 import os
 import sys
 import tempfile
+import threading
+import time
+import gzip
+import zipfile
 from fb2rename import *
 
 
@@ -17,6 +21,29 @@ def get_files(a_path=os.getcwd(), a_abspath=True):
     return lsdir
 
 
+def make_fb2(a_path, a_authors=[('First', 'Middle', 'Last')], a_title='Title',
+             a_sequence=('Sequence', '7'), a_date='2010-03-04', a_tail=''):
+    authors = ''.join(
+        '<author><first-name>%s</first-name><middle-name>%s</middle-name>'
+        '<last-name>%s</last-name></author>' % a for a in a_authors)
+    sequence = ''
+    if a_sequence:
+        sequence = '<sequence name="%s" number="%s"/>' % a_sequence
+    date = ''
+    if a_date:
+        date = '<date value="%s">%s</date>' % (a_date, a_date)
+    content = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0">'
+        '<description><title-info><genre>sf</genre>' + authors +
+        '<book-title>' + a_title + '</book-title>' + date + sequence +
+        '</title-info></description>'
+        '<body><p>text</p></body>' + a_tail)
+    with open(a_path, 'wb') as f:
+        f.write(content)
+    return a_path
+
+
 class CommonTest(unittest.TestCase):
     str_ch = r"lineOnlyWithCharachters"
     str_chNums = r"0line2Only7WithChara3456chters0"
@@ -92,6 +119,24 @@ class CommonTest(unittest.TestCase):
         str_result = Common.replace(self.str_chSymb, str_forbidden, '_')
         self.assertEqual(self.str_chUndr, str_result)
 
+    def test_validateFilename_replacesCharsAndWhitespace(self):
+        self.assertEqual(
+            u"n1 'a' - b_ c. d",
+            Common.validate_filename(u' №1  «a» – b…\tc? d '))
+
+    def test_validateFilename_treatsSlashesAsSeparators(self):
+        self.assertEqual(
+            os.path.join(u'seq', u'1. title.fb2'),
+            Common.validate_filename(u'seq\\1. title.fb2'))
+
+    def test_validateFilename_dropsDotComponents(self):
+        self.assertEqual(
+            os.path.join(u'a', u'1. title.fb2'),
+            Common.validate_filename(u'..\\a/./..\\1. title.fb2'))
+
+    def test_validateTag_replacesSlashes(self):
+        self.assertEqual(u'a.b.c', Common.validate_tag('a/b\\c'))
+
     def test_getTemplates_returnsDictWithDefaultKey(self):
         self.assertTrue('default' in Common.get_templates())
 
@@ -220,6 +265,1265 @@ class GetFilesToWorkWith(unittest.TestCase):
         files = get_files_to_work_with(get_files(os.getcwd()), types, path, True)
         self.assertEqual(sorted(ref), sorted(files))
 
+    def test_iterFiles_isLazy(self):
+        files = iter_files_to_work_with([], ['fb2'], [self.tmpdir])
+        self.assertTrue(next(files).endswith('.fb2'))
+
+    def test_dirEntry_statsOnce_unlessEntryIsSymlink(self):
+        calls = []
+        saved_stat, saved_lstat = os.stat, os.lstat
+
+        def counted(a_func):
+            return lambda a_path: calls.append(a_path) or a_func(a_path)
+        os.stat, os.lstat = counted(saved_stat), counted(saved_lstat)
+        try:
+            entry = DirEntry(self.tmpdir, 'file1.fb2')
+            self.assertFalse(entry.is_dir(follow_symlinks=False))
+            self.assertTrue(entry.is_file())
+            entry.inode()
+        finally:
+            os.stat, os.lstat = saved_stat, saved_lstat
+        self.assertEqual(1, len(calls))
+
+    def test_skipsHardlinks_whenFileIsAlreadyFound(self):
+        source = os.path.join(self.tmpdir, 'dir1', 'file1.fb2')
+        link = os.path.join(self.tmpdir, 'dir2', 'hardlink.fb2')
+        os.link(source, link)
+        try:
+            files = get_files_to_work_with([], ['fb2'], [self.tmpdir], True)
+        finally:
+            os.remove(link)
+        self.assertEqual(6, len(files))
+        self.assertEqual(1, len([f for f in files if f in (source, link)]))
+
+
+class SanitizerTest(unittest.TestCase):
+
+    def test_fat_replacesReservedCharsAndNames(self):
+        sanitizer = Sanitizer('fat')
+        self.assertEqual(
+            u'a_b_c (d)', sanitizer.validate_component(u'a+b;c [d]. '))
+        self.assertEqual(u'_con.fb2', sanitizer.validate_component(u'con.fb2'))
+
+    def test_translit_convertsCyrillic(self):
+        sanitizer = Sanitizer(a_translit=True)
+        self.assertEqual(
+            u'Shchukin Zhenya.fb2',
+            sanitizer.validate_filename(u'Щукин Женя.fb2'))
+
+    def test_truncate_keepsExtensionAndWholeCharacters(self):
+        sanitizer = Sanitizer(a_max_bytes=20)
+        name = sanitizer.validate_filename(u'Ж' * 30 + u'.fb2.zip')
+        self.assertEqual(u'Ж' * 6 + u'.fb2.zip', name)
+        self.assertTrue(len(name.encode('utf-8')) <= 20)
+
+
+class BookInpxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.inpx = os.path.join(self.tmpdir, 'library.inpx')
+        self.folder = os.path.join(self.tmpdir, 'fb2-001000-001999')
+        os.mkdir(self.folder)
+        records = [u'\x04'.join([
+            u'Фамилия,Имя,Отчество:Second,Author,:', u'sf:det:', title,
+            u'Series', u'3', name, u'100', name, deleted, u'fb2',
+            u'2010-01-01', u'ru', u'', u''])
+            for name, title, deleted in (
+                (u'1001', u'Indexed title', u'0'),
+                (u'1003', u'Deleted title', u'1'))]
+        with zipfile.ZipFile(self.inpx, 'w') as archive:
+            archive.writestr(
+                'fb2-001000-001999.inp',
+                u'\r\n'.join(records).encode('utf-8'))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_open_readsMetaFromIndex(self):
+        book = Book_inpx(self.inpx)
+        book.open(make_fb2(os.path.join(self.folder, '1001.fb2')))
+        self.assertEqual(
+            [(u'Имя', u'Отчество', u'Фамилия'), (u'Author', u'', u'Second')],
+            book.meta.authors)
+        self.assertEqual([u'sf', u'det'], book.meta.genres)
+        self.assertEqual(u'Series-3', book.get_value('sequence'))
+        self.assertEqual(u'Indexed title', book.get_value('title'))
+        self.assertEqual(u'2010', book.get_value('year'))
+
+    def test_computeNames_parsesBooks_missingFromIndex(self):
+        indexed = make_fb2(os.path.join(self.folder, '1001.fb2.zip'))
+        missing = make_fb2(os.path.join(self.folder, '1002.fb2'))
+        deleted = make_fb2(os.path.join(self.folder, '1003.fb2'))
+        elsewhere = make_fb2(os.path.join(self.tmpdir, '1001.fb2'))
+        with zipfile.ZipFile(indexed, 'w') as archive:
+            archive.write(missing, '1001.fb2')
+        items = list(compute_names(
+            [indexed, missing, deleted, elsewhere], NameTemplate('%title%'),
+            a_sources=[Book_inpx(self.inpx)]))
+        self.assertEqual(
+            [u'Indexed title.fb2.zip', u'Title.fb2', u'Title.fb2',
+             u'Title.fb2'], [i.name for i in items])
+
+
+class NameTemplateTest(unittest.TestCase):
+
+    def test_compile_splitsLiteralsAndFields(self):
+        template = NameTemplate('%authors #F #L% - %title%')
+        self.assertEqual(
+            [(True, 'authors #F #L'), (False, ' - '), (True, 'title')],
+            template.tokens)
+        self.assertEqual(['authors', 'title'], template.fields)
+
+    def test_validate_throws_whenFieldIsUnknown(self):
+        template = NameTemplate('%authors% - %titel%')
+        self.assertEqual(['%titel%'], template.unknown)
+        self.assertRaises(Exception, template.validate)
+
+    def test_validate_doesNotThrow_forPredefinedTemplates(self):
+        for t in Common.get_templates().values():
+            NameTemplate(t).validate()
+
+    def test_validate_throws_whenHashLengthIsInvalid(self):
+        NameTemplate('%hash 40%').validate()
+        for value in ('%hash x%', '%hash 0%', '%hash 41%'):
+            self.assertRaises(Exception, NameTemplate(value).validate)
+
+    def test_render_keepsLoneLiteralPercent(self):
+        template = NameTemplate('100% %title%')
+        self.assertEqual([(False, '100% '), (True, 'title')], template.tokens)
+
+    def test_render_shardsByLetterAndHash(self):
+        meta = BookMeta()
+        meta.authors = [(u'First', u'', u'ёлкин')]
+        meta.title = u'Title'
+        book = Book_fb2()
+        book.load('book.fb2', meta)
+        self.assertEqual(u'Ё', NameTemplate('%letter%').render(book))
+        digest = NameTemplate('%hash 3%').render(book)
+        self.assertEqual(3, len(digest))
+        meta.authors = [('First', '', u'ёлкин')]
+        self.assertEqual(digest, NameTemplate('%hash 3%').render(book))
+
+
+class BookFb2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_parseHeader_stopsAfterDescription(self):
+        path = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        root = Book_fb2.parse_header(path)
+        tags = [etree.QName(e).localname for e in root]
+        self.assertEqual(['description'], tags)
+
+    def test_open_readsHeader_whenBodyIsMalformed(self):
+        path = make_fb2(
+            os.path.join(self.tmpdir, 'book.fb2'), a_tail='<binary><p>')
+        book = Book_fb2()
+        book.open(path)
+        self.assertEqual('Title', book.get_value('title'))
+
+    def test_open_fallsBackToFullParse_whenHeaderIsMalformed(self):
+        path = os.path.join(self.tmpdir, 'book.fb2')
+        with open(path, 'wb') as f:
+            f.write(
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0">'
+                '<description><title-info><book-title>Title</book-title>'
+                '<p></title-info></description>')
+        book = Book_fb2()
+        book.open(path)
+        self.assertEqual('Title', book.get_value('title'))
+
+    def test_formatName_rendersSubformats(self):
+        path = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        book = Book_fb2()
+        book.open(path)
+        self.assertEqual(
+            'First Last - Sequence 7. Title',
+            format_name(book, '%authors #F #L% - %seq_name% %seq_number%. %title%'))
+
+    def test_open_readsZippedBook(self):
+        path = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        archive = zipfile.ZipFile(path + '.zip', 'w', zipfile.ZIP_DEFLATED)
+        archive.write(path, 'book.fb2')
+        archive.close()
+        book = Book_fb2()
+        book.open(path + '.zip')
+        self.assertEqual('Title', book.get_value('title'))
+        self.assertEqual('book', book.get_value('oldname'))
+        self.assertEqual('.fb2.zip', book.get_extension())
+
+    def test_computeName_keepsCompressedExtension(self):
+        path = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        with open(path, 'rb') as src:
+            dst = gzip.open(path + '.gz', 'wb')
+            dst.write(src.read())
+            dst.close()
+        item = compute_name(Book_fb2(), path + '.gz', NameTemplate('%title%'))
+        self.assertEqual(u'Title.fb2.gz', item.name)
+
+    def test_open_extractsAllAuthorsAndSequences(self):
+        path = make_fb2(
+            os.path.join(self.tmpdir, 'book.fb2'),
+            a_authors=[('A', '', 'B'), ('C', 'D', 'E')])
+        book = Book_fb2()
+        book.open(path)
+        self.assertEqual([('A', '', 'B'), ('C', 'D', 'E')], book.meta.authors)
+        self.assertEqual([('Sequence', '7')], book.meta.sequences)
+        self.assertEqual(['sf'], book.meta.genres)
+        self.assertEqual('B, A; E, C D', book.get_value('authors'))
+        self.assertEqual('book', book.get_value('oldname'))
+
+    def test_open_extractsOnlyRequestedFields(self):
+        path = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        book = Book_fb2()
+        book.open(path, ['year', 'date'])
+        self.assertEqual('2010-03-04', book.meta.date)
+        self.assertEqual([], book.meta.authors)
+        self.assertEqual(None, book.meta.title)
+        self.assertEqual('2010', book.get_value('year'))
+
+    def test_getValue_throws_whenFieldIsMissing(self):
+        path = make_fb2(
+            os.path.join(self.tmpdir, 'book.fb2'), a_sequence=None)
+        book = Book_fb2()
+        book.open(path)
+        self.assertRaises(Exception, book.get_value, 'seq_name')
+
+    def test_getValue_followsFallbackChain_whenFieldIsMissing(self):
+        path = os.path.join(self.tmpdir, 'old name.fb2')
+        with open(path, 'wb') as f:
+            f.write(
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0">'
+                '<description><title-info><book-title> </book-title>'
+                '</title-info><publish-info><book-name>Published</book-name>'
+                '<year>printed 1999</year></publish-info></description>'
+                '</FictionBook>')
+        book = Book_fb2()
+        book.open(path, ['title', 'year'])
+        self.assertEqual('Published', book.get_value('title'))
+        self.assertEqual('1999', book.get_value('year'))
+        book.meta.bookname = None
+        self.assertRaises(Exception, book.get_value, 'title')
+        fallbacks = BookMeta.get_fallbacks(['title=bookname,oldname'])
+        self.assertEqual('old name', book.get_value('title', fallbacks))
+        self.assertEqual(
+            u'old name', NameTemplate('%title%', fallbacks).render(book))
+
+    def test_getFallbacks_replacesDefaultChain(self):
+        fallbacks = BookMeta.get_fallbacks(['title=', 'date=year'])
+        self.assertEqual([], fallbacks['title'])
+        self.assertEqual(['year'], fallbacks['date'])
+        self.assertEqual(['pub_year'], fallbacks['year'])
+        self.assertRaises(Exception, BookMeta.get_fallbacks, ['title=titel'])
+
+
+class ComputeNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.files = []
+        for i in range(20):
+            path = os.path.join(self.tmpdir, 'book%02d.fb2' % i)
+            self.files.append(make_fb2(path, a_title='Title %02d' % i))
+        self.broken = os.path.join(self.tmpdir, 'broken.fb2')
+        open(self.broken, 'w').close()
+        self.files.insert(5, self.broken)
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def get_results(self, a_jobs):
+        template = NameTemplate('%title%')
+        items = compute_names(self.files, template, a_jobs=a_jobs, a_chunk_size=3)
+        return [(i.fname, i.name, i.error is None) for i in items]
+
+    def test_returnsItemsInInputOrder_whenJobsAreUsed(self):
+        results = self.get_results(3)
+        self.assertEqual(self.files, [r[0] for r in results])
+        self.assertEqual(self.get_results(1), results)
+
+    def test_reportsErrorsFromWorkers(self):
+        items = list(compute_names(self.files, NameTemplate('%title%'), a_jobs=2))
+        errors = [i.fname for i in items if i.error is not None]
+        self.assertEqual([self.broken], errors)
+        self.assertEqual(u'Title 00.fb2', items[0].name)
+        self.assertEqual('Title 00', items[0].meta.title)
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.files = []
+        for i in range(10):
+            path = os.path.join(self.tmpdir, 'book%02d.fb2' % i)
+            self.files.append(make_fb2(path, a_title='Title %02d' % i))
+        self.inodes = dict((os.stat(f).st_ino, f) for f in self.files)
+        self.advised = []
+        self.ahead = threading.Event()
+        self.fadvise = Prefetcher.fadvise
+        Prefetcher.fadvise = staticmethod(self.record)
+
+    def tearDown(self):
+        Prefetcher.fadvise = self.fadvise
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def record(self, a_fd, a_offset, a_length):
+        path = self.inodes[os.fstat(a_fd).st_ino]
+        self.advised.append((path, a_offset, a_length))
+        if len(self.advised) >= 4:
+            self.ahead.set()
+
+    def test_iter_keepsOrderAndMissingFiles(self):
+        files = self.files + [os.path.join(self.tmpdir, 'missing.fb2')]
+        prefetcher = Prefetcher(a_threads=3, a_depth=4, a_size=16)
+        self.assertEqual(files, list(prefetcher.iter(files)))
+
+    def test_iter_readsAheadOfConsumer(self):
+        prefetcher = Prefetcher(a_threads=2, a_depth=4, a_size=16)
+        files = prefetcher.iter(self.files)
+        self.assertEqual(self.files[0], next(files))
+        self.assertTrue(self.ahead.wait(5))
+        self.assertEqual(self.files[1:], list(files))
+        self.assertEqual(
+            sorted((f, 0, 16) for f in self.files), sorted(self.advised))
+
+
+class RenameBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.book = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        self.broken = os.path.join(self.tmpdir, 'broken.fb2')
+        open(self.broken, 'w').close()
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_yieldsResults_withoutRenaming_whenDryRun(self):
+        items = rename_batch(
+            [self.book, self.broken], '%title%', self.out_dir, a_dry_run=True)
+        results = [i.to_dict() for i in items]
+        self.assertEqual(self.book, results[0]['old'])
+        self.assertEqual(
+            os.path.join(self.out_dir, 'Title.fb2'), results[0]['new'])
+        self.assertEqual('Title', results[0]['fields']['title'])
+        self.assertEqual(None, results[0]['error'])
+        self.assertTrue(results[1]['error'])
+        self.assertTrue(os.path.exists(self.book))
+
+    def test_renamesBooks(self):
+        items = list(rename_batch([self.book], '%title%', self.out_dir))
+        self.assertFalse(os.path.exists(self.book))
+        self.assertTrue(os.path.exists(items[0].target))
+
+    def test_createsDirectories_beforeRenamingEachGroup(self):
+        books = [self.book] + [make_fb2(
+            os.path.join(self.tmpdir, '%d.fb2' % i), a_sequence=(s, '1'))
+            for i, s in enumerate(['One', 'Two'])]
+        items = rename_batch(books, '%seq_name%\\%title%', self.out_dir)
+        next(items)
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, 'One')))
+        next(items)
+        self.assertTrue(os.path.isdir(os.path.join(self.out_dir, 'Two')))
+        self.assertTrue(os.path.exists(books[2]))
+
+    def test_createsDirectories_onlyForClaimedTargets(self):
+        os.mkdir(os.path.join(self.out_dir, 'One'))
+        open(os.path.join(self.out_dir, 'One', 'Title.fb2'), 'w').close()
+        books = [make_fb2(
+            os.path.join(self.tmpdir, '%d.fb2' % i), a_sequence=(s, '1'))
+            for i, s in enumerate(['One', 'Two'])]
+        items = list(rename_batch(
+            books, '%seq_name%\\%title%', self.out_dir,
+            a_targets=TargetIndex('fail')))
+        self.assertEqual(1, len(items))
+        self.assertEqual(['One'], os.listdir(self.out_dir))
+
+    def test_throws_whenTemplateIsInvalid(self):
+        items = rename_batch([self.book], '%titel%', self.out_dir)
+        self.assertRaises(Exception, list, items)
+        self.assertTrue(os.path.exists(self.book))
+
+
+class OutputTest(unittest.TestCase):
+
+    class Stream(object):
+
+        def __init__(self):
+            self.data = []
+
+        def write(self, a_text):
+            if isinstance(a_text, unicode):
+                a_text = a_text.encode('utf-8')
+            self.data.append(a_text)
+
+        def flush(self):
+            pass
+
+        def get_lines(self):
+            return ''.join(self.data).splitlines()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.book = make_fb2(os.path.join(self.tmpdir, 'книга1.fb2'),
+                             a_title='Книга')
+        self.stdout = sys.stdout
+        sys.stdout = self.Stream()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_printsJsonl_whenFileNameIsNotAscii(self):
+        errors = {}
+        items = rename_batch(
+            [self.book], '%title%', self.out_dir, a_dry_run=True)
+        print_items(items, errors, {}, {}, True)
+        print_summary({self.book: Exception('failed')}, {}, {}, True)
+        records = [json.loads(l) for l in sys.stdout.get_lines()]
+        self.assertEqual(Common.decode_path(self.book), records[0]['old'])
+        self.assertEqual(
+            os.path.join(Common.decode_path(self.out_dir), u'Книга.fb2'),
+            records[0]['new'])
+        self.assertEqual(
+            Common.decode_path(self.book) + u': failed', records[1]['error'])
+
+    def test_printsSkipped_whenFileNameIsNotAscii(self):
+        target = os.path.join(self.out_dir, 'Книга.fb2')
+        open(target, 'w').close()
+        skipped = {}
+        items = rename_batch(
+            [self.book], '%title%', self.out_dir, a_dry_run=True,
+            a_targets=TargetIndex('skip'))
+        print_items(items, {}, {}, skipped, False)
+        print_summary({}, {}, skipped, False)
+        lines = sys.stdout.get_lines()
+        self.assertEqual(
+            '  %s => %s already exists' % (self.book, target), lines[1])
+        self.assertEqual('Errors: ', lines[2])
+
+    def test_printsDuplicates_whenFileNameIsNotAscii(self):
+        copy = os.path.join(self.tmpdir, 'книга2.fb2')
+        shutil.copy(self.book, copy)
+        duplicates = {}
+        items = rename_batch(
+            [self.book, copy], '%title%', self.out_dir, a_dedup='skip')
+        print_items(items, {}, duplicates, {}, False)
+        print_summary({}, duplicates, {}, False)
+        lines = sys.stdout.get_lines()
+        target = os.path.join(self.out_dir, 'Книга.fb2')
+        self.assertEqual('  %s == %s' % (copy, target), lines[2])
+        self.assertEqual('Errors: ', lines[3])
+
+
+class RenameArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.archive = os.path.join(self.tmpdir, 'library.zip')
+        with zipfile.ZipFile(self.archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, title in (('1.fb2', 'One'), ('2.fb2', 'Two')):
+                path = make_fb2(os.path.join(self.tmpdir, name), a_title=title)
+                z.write(path, 'books/' + name)
+                os.remove(path)
+            z.writestr('readme.txt', 'not a book')
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_extractsMembers_underTemplatedNames(self):
+        items = list(rename_archive(self.archive, '%title%', self.out_dir))
+        self.assertEqual([u'One.fb2', u'Two.fb2'], [i.name for i in items])
+        self.assertEqual(
+            ['One.fb2', 'Two.fb2'], sorted(os.listdir(self.out_dir)))
+        self.assertEqual(
+            u'One', Book_fb2.extract_meta(Book_fb2.parse_header(
+                items[0].target)).title)
+
+    def test_packsEachMember_whenOutputIsZip(self):
+        items = list(rename_archive(
+            self.archive, '%title%', self.out_dir, a_output='zip'))
+        with zipfile.ZipFile(items[1].target) as z:
+            self.assertEqual(['Two.fb2'], z.namelist())
+            self.assertEqual(None, z.testzip())
+
+    def test_repacksArchive_withRenamedMembers(self):
+        with zipfile.ZipFile(self.archive, 'a') as z:
+            z.writestr('books/3.fb2', 'not xml')
+        items = list(rename_archive(
+            self.archive, '%title%', self.out_dir, a_output='repack'))
+        self.assertTrue(items[2].error)
+        with zipfile.ZipFile(os.path.join(self.out_dir, 'library.zip')) as z:
+            self.assertEqual(
+                ['One.fb2', 'Two.fb2', 'books/3.fb2', 'readme.txt'],
+                sorted(z.namelist()))
+            self.assertEqual('not xml', z.read('books/3.fb2'))
+            self.assertEqual(None, z.testzip())
+
+    def test_repack_refusesToReplaceSource(self):
+        items = rename_archive(
+            self.archive, '%title%', self.tmpdir, a_output='repack')
+        self.assertRaises(IOError, list, items)
+        with zipfile.ZipFile(self.archive) as z:
+            self.assertEqual(
+                ['books/1.fb2', 'books/2.fb2', 'readme.txt'], z.namelist())
+
+
+class TargetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.src = os.path.join(self.tmpdir, 'src.fb2')
+        open(os.path.join(self.tmpdir, 'Book.fb2.zip'), 'w').close()
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def claim(self, a_index, a_name):
+        return a_index.claim(self.src, os.path.join(self.tmpdir, a_name))
+
+    def test_claim_usesNumberedPages_whenDirectoryIsFull(self):
+        index = TargetIndex('suffix', a_max_entries=2)
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'A.fb2'), self.claim(index, 'A.fb2'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, '0001', 'B.fb2'),
+            self.claim(index, 'B.fb2'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, '0001', 'C.fb2'),
+            self.claim(index, 'C.fb2'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, '0002', 'D.fb2'),
+            self.claim(index, 'D.fb2'))
+
+    def test_claim_addsSuffixBeforeBookExtension(self):
+        index = TargetIndex('suffix')
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'Book (1).fb2.zip'),
+            self.claim(index, 'Book.fb2.zip'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'Book (2).fb2.zip'),
+            self.claim(index, 'Book.fb2.zip'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'Other.fb2'),
+            self.claim(index, 'Other.fb2'))
+
+    def test_claim_keepsSuffixWithinMaxBytes(self):
+        index = TargetIndex('suffix', a_max_bytes=20)
+        open(os.path.join(self.tmpdir, 'x' * 16 + '.fb2'), 'w').close()
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'x' * 12 + ' (1).fb2'),
+            self.claim(index, 'x' * 16 + '.fb2'))
+
+    def test_claim_ignoresCase_whenCaseInsensitive(self):
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'book.fb2.zip'),
+            self.claim(TargetIndex('suffix'), 'book.fb2.zip'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'book (1).fb2.zip'),
+            self.claim(TargetIndex('suffix', True), 'book.fb2.zip'))
+
+    def test_claim_appliesPolicies(self):
+        self.assertEqual(None, self.claim(TargetIndex('skip'), 'Book.fb2.zip'))
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'Book.fb2.zip'),
+            self.claim(TargetIndex('overwrite'), 'Book.fb2.zip'))
+        self.assertRaises(
+            Exception, self.claim, TargetIndex('fail'), 'Book.fb2.zip')
+
+    def test_claim_allowsBookToKeepItsName(self):
+        index = TargetIndex('fail')
+        target = os.path.join(self.tmpdir, 'Book.fb2.zip')
+        self.assertEqual(target, index.claim(target, target))
+
+    def test_renameBatch_keepsBook_alreadyAtItsTarget(self):
+        kept = make_fb2(os.path.join(self.tmpdir, 'Title.fb2'), a_tail='kept')
+        other = make_fb2(os.path.join(self.tmpdir, 'x.fb2'), a_tail='other')
+        items = list(rename_batch([kept, other], '%title%', self.tmpdir))
+        self.assertEqual(
+            [kept, os.path.join(self.tmpdir, 'Title (1).fb2')],
+            [i.target for i in items])
+        with open(kept) as f:
+            self.assertTrue(f.read().endswith('kept'))
+        self.assertTrue(os.path.exists(items[1].target))
+
+    def test_renameBatch_probesTargets_onlyOnCollision(self):
+        out_dir = os.path.join(self.tmpdir, 'out')
+        books = [make_fb2(os.path.join(self.tmpdir, '%d.fb2' % i),
+                          a_title='Title %d' % i) for i in range(10)]
+        probes = []
+        lexists = os.path.lexists
+        os.path.lexists = lambda a_path: probes.append(a_path) or \
+            lexists(a_path)
+        try:
+            items = list(rename_batch(books, '%title%', out_dir))
+        finally:
+            os.path.lexists = lexists
+        self.assertEqual(10, len([i for i in items if i.error is None]))
+        self.assertEqual([], probes)
+
+    def test_renameBatch_stops_whenPolicyIsFail(self):
+        books = [
+            make_fb2(os.path.join(self.tmpdir, '%d.fb2' % i)) for i in range(3)]
+        items = list(rename_batch(
+            books, '%title%', self.tmpdir, a_dry_run=True,
+            a_targets=TargetIndex('fail')))
+        self.assertEqual(2, len(items))
+        self.assertTrue(items[1].error)
+
+    def test_renameBatch_reportsSkippedBooks_withoutError(self):
+        books = [
+            make_fb2(os.path.join(self.tmpdir, '%d.fb2' % i)) for i in range(2)]
+        stats = RunStats()
+        items = list(rename_batch(
+            books, '%title%', self.tmpdir, a_dry_run=True, a_stats=stats,
+            a_targets=TargetIndex('skip')))
+        self.assertEqual(
+            [None, os.path.join(self.tmpdir, 'Title.fb2')],
+            [i.skipped for i in items])
+        self.assertEqual([None, None], [i.error for i in items])
+        self.assertEqual((0, 1), (stats.errors, stats.skipped))
+
+
+class DuplicateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.first = make_fb2(os.path.join(self.tmpdir, 'a.fb2'))
+        self.copy = os.path.join(self.tmpdir, 'b.fb2')
+        shutil.copy(self.first, self.copy)
+        self.other = make_fb2(
+            os.path.join(self.tmpdir, 'c.fb2'), a_tail='<binary>x</binary>')
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def rename(self, a_files, a_dedup, a_template='%title% %oldname%'):
+        return list(rename_batch(
+            a_files, a_template, self.out_dir, a_dedup=a_dedup))
+
+    def test_skipsCopies_whenDedupIsSkip(self):
+        items = self.rename([self.first, self.copy, self.other], 'skip')
+        self.assertEqual(
+            [None, items[0].target, None], [i.duplicate for i in items])
+        self.assertTrue(os.path.exists(self.copy))
+        self.assertEqual(2, len(os.listdir(self.out_dir)))
+
+    def test_comparesFingerprints_whenPathWasRenamed(self):
+        items = self.rename([self.first, self.copy], 'report')
+        self.assertEqual(items[0].target, items[1].duplicate)
+        self.assertEqual(2, len(os.listdir(self.out_dir)))
+
+    def test_replacesCopyWithHardlink_whenDedupIsLink(self):
+        items = self.rename([self.first, self.copy], 'link')
+        self.assertEqual(
+            os.stat(items[0].target).st_ino, os.stat(self.copy).st_ino)
+
+    def test_getMetaKey_ignoresStringTypes(self):
+        parsed, cached = BookMeta(), BookMeta()
+        parsed.authors = [('First', None, 'Last')]
+        parsed.title = 'Title'
+        cached.authors = [(u'First', None, u'Last')]
+        cached.title = u'Title'
+        self.assertEqual(
+            DuplicateIndex.get_meta_key(parsed),
+            DuplicateIndex.get_meta_key(cached))
+
+    def test_findsCopies_byDocumentId(self):
+        item = RenameItem(self.first)
+        item.meta = BookMeta()
+        item.meta.doc_id = ' {ABC-1} '
+        index = DuplicateIndex()
+        index.add(item, self.first)
+        copy = RenameItem(self.copy)
+        copy.meta = BookMeta()
+        copy.meta.doc_id = 'abc-1'
+        self.assertEqual(self.first, index.find(copy))
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_parseEvents_splitsNamesAndPadding(self):
+        data = Inotify.event_header.pack(1, Inotify.IN_MOVED_TO, 5, 8) + \
+            'a.fb2\0\0\0' + \
+            Inotify.event_header.pack(1, Inotify.IN_CLOSE_WRITE, 0, 0)
+        self.assertEqual(
+            [(1, Inotify.IN_MOVED_TO, 5, 'a.fb2'),
+             (1, Inotify.IN_CLOSE_WRITE, 0, '')],
+            Inotify.parse_events(data))
+
+    def test_poll_returnsSettledBooksOnce(self):
+        existing = make_fb2(os.path.join(self.tmpdir, 'a.fb2'))
+        watcher = Watcher(self.tmpdir, ['fb2'], a_settle=0.05)
+        try:
+            added = make_fb2(os.path.join(self.tmpdir, 'b.fb2'))
+            open(os.path.join(self.tmpdir, 'c.txt'), 'w').close()
+            files = []
+            for i in range(10):
+                files.extend(watcher.poll())
+                if len(files) == 2:
+                    break
+            self.assertEqual(sorted([existing, added]), sorted(files))
+            os.rename(added, os.path.join(self.tmpdir, 'renamed.fb2'))
+            watcher.settle = 0
+            self.assertEqual([], watcher.poll())
+            watcher.retry([existing])
+            self.assertEqual([existing], watcher.poll())
+        finally:
+            watcher.close()
+
+
+class MetaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.book = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        self.cache = MetaCache(os.path.join(self.tmpdir, 'cache', 'meta.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_get_returnsStoredMeta(self):
+        book = Book_fb2()
+        book.open(self.book)
+        key = MetaCache.get_key(self.book)
+        self.cache.put(key, book.meta)
+        meta = self.cache.get(key)
+        self.assertEqual(book.meta.authors, meta.authors)
+        self.assertEqual(book.meta.sequences, meta.sequences)
+        self.assertEqual('Title', meta.title)
+
+    def test_get_returnsNone_whenFileChanged(self):
+        book = Book_fb2()
+        book.open(self.book)
+        self.cache.put(MetaCache.get_key(self.book), book.meta)
+        make_fb2(self.book, a_title='Another title')
+        self.assertEqual(None, self.cache.get(MetaCache.get_key(self.book)))
+
+    def test_computeNames_doesNotParse_whenBookIsCached(self):
+        template = NameTemplate('%title%')
+        os.utime(self.book, (1000000000, 1000000000))
+        list(compute_names([self.book], template, a_cache=self.cache))
+        with open(self.book, 'r+b') as f:
+            f.write('x' * 10)
+        os.utime(self.book, (1000000000, 1000000000))
+        items = list(compute_names([self.book], template, a_cache=self.cache))
+        self.assertEqual(u'Title.fb2', items[0].name)
+
+    def test_close_evictsLeastRecentlyUsed(self):
+        self.cache.max_entries = 2
+        meta = BookMeta()
+        for i in range(5):
+            self.cache.put((1, i, 0, 0), meta)
+        self.cache.close()
+        self.cache = MetaCache(self.cache.path)
+        count = self.cache.db.execute('SELECT COUNT(*) FROM meta').fetchone()
+        self.assertEqual(2, count[0])
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.book = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def index(self, a_name):
+        catalog = Catalog.open(os.path.join(self.tmpdir, a_name))
+        items = list(index_books([self.book], catalog))
+        catalog.close()
+        return items
+
+    def test_index_writesSearchableTables(self):
+        self.index('catalog.sqlite')
+        db = sqlite3.connect(os.path.join(self.tmpdir, 'catalog.sqlite'))
+        row = db.execute(
+            'SELECT b.title, s.number FROM books b '
+            'JOIN authors a ON a.book_id = b.id '
+            'JOIN sequences s ON s.book_id = b.id '
+            'WHERE a.last = ? AND s.name = ?', ('Last', 'Sequence')).fetchone()
+        db.close()
+        self.assertEqual((u'Title', u'7'), row)
+
+    def test_index_skipsUnchangedFiles(self):
+        self.assertEqual(1, len(self.index('catalog.sqlite')))
+        self.assertEqual(0, len(self.index('catalog.sqlite')))
+        make_fb2(self.book, a_title='Another title')
+        self.assertEqual(1, len(self.index('catalog.sqlite')))
+
+    def test_computeNames_usesCsvCatalog_withoutParsing(self):
+        os.utime(self.book, (1000000000, 1000000000))
+        self.index('catalog.csv')
+        with open(self.book, 'r+b') as f:
+            f.write('x' * 10)
+        os.utime(self.book, (1000000000, 1000000000))
+        path = os.path.join(self.tmpdir, 'catalog.csv')
+        os.utime(path, (1000000000, 1000000000))
+        catalog = Catalog.open(path)
+        items = list(compute_names(
+            [self.book], NameTemplate('%title%'), a_sources=[catalog]))
+        catalog.close()
+        self.assertEqual(u'Title.fb2', items[0].name)
+        self.assertEqual(1000000000, os.stat(path).st_mtime)
+
+    def test_open_refusesForeignDatabase(self):
+        path = os.path.join(self.tmpdir, 'other.sqlite')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE books (name TEXT)')
+        db.commit()
+        db.close()
+        self.assertRaises(sqlite3.DatabaseError, Catalog.open, path)
+        db = sqlite3.connect(path)
+        columns = [r[1] for r in db.execute('PRAGMA table_info(books)')]
+        db.close()
+        self.assertEqual([u'name'], columns)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.out_dir)
+        self.book = make_fb2(os.path.join(self.tmpdir, 'book.fb2'))
+        self.path = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_undo_restoresRenamedBooks(self):
+        journal = Journal(self.path)
+        items = list(rename_batch(
+            [self.book], '%title%', self.out_dir, a_journal=journal))
+        journal.close()
+        self.assertFalse(os.path.exists(self.book))
+        journal = Journal(self.path, a_resume=True)
+        undone = list(journal.undo())
+        journal.close()
+        self.assertTrue(os.path.exists(self.book))
+        self.assertFalse(os.path.exists(items[0].target))
+        self.assertEqual(self.book, undone[0].target)
+
+    def test_resume_skipsBooksMoved_beforeTheirDoneRecord(self):
+        target = os.path.join(self.out_dir, 'Title.fb2')
+        journal = Journal(self.path)
+        journal.plan(self.book, target, 'move')
+        journal.close()
+        os.rename(self.book, target)
+        with open(self.path, 'ab') as f:
+            f.write('{"op": "do')
+        journal = Journal(self.path, a_resume=True)
+        self.assertEqual([], list(journal.filter([target])))
+        journal.close()
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read().endswith('}\n'))
+
+    def test_resume_keepsExistingTarget_ofUnfinishedRename(self):
+        target = make_fb2(
+            os.path.join(self.out_dir, 'Title.fb2'), a_title='Other')
+        journal = Journal(self.path)
+        journal.plan(self.book, target, 'copy')
+        open(target + '.fb2rename', 'w').close()
+        journal = Journal(self.path, a_resume=True)
+        journal.close()
+        self.assertTrue(os.path.exists(target))
+        self.assertFalse(os.path.exists(target + '.fb2rename'))
+        self.assertEqual([self.book], list(journal.filter([self.book])))
+
+    def test_renameBatch_fsyncsPlansOncePerGroup(self):
+        books = [make_fb2(os.path.join(self.tmpdir, '%d.fb2' % i),
+                          a_title='Title %d' % i) for i in range(5)]
+        journal = Journal(self.path, a_group_size=2)
+        syncs = []
+        sync = journal.sync
+        journal.sync = lambda: syncs.append(len(journal.buffer)) or sync()
+        planned = []
+        apply = FileOps.apply
+
+        def check(a_mode, a_src, a_dst):
+            with open(self.path, 'rb') as f:
+                records = [json.loads(l) for l in f]
+            planned.append(Catalog.get_path_key(a_src) in [
+                r['src'] for r in records if r['op'] == 'plan'])
+            apply(a_mode, a_src, a_dst)
+        FileOps.apply = staticmethod(check)
+        try:
+            list(rename_batch(
+                books, '%title%', self.out_dir, a_journal=journal))
+        finally:
+            FileOps.apply = staticmethod(apply)
+        journal.close()
+        self.assertEqual([True] * 5, planned)
+        self.assertEqual(4, len(syncs))
+
+    def test_init_throws_whenJournalExistsWithoutResume(self):
+        Journal(self.path).close()
+        self.assertRaises(Exception, Journal, self.path)
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_filter_partitionsFiles_independentlyOfMountPoint(self):
+        names = ['dir/book%d.fb2' % i for i in range(50)]
+        shards = []
+        for i in range(3):
+            shard = Shard.parse('%d/3' % i)
+            shards.append(set(shard.filter(
+                [os.path.join(self.tmpdir, n) for n in names], [self.tmpdir])))
+            other = set(shard.filter(
+                [os.path.join('/mnt', n) for n in names], ['/mnt']))
+            self.assertEqual(
+                set(os.path.relpath(p, self.tmpdir) for p in shards[-1]),
+                set(os.path.relpath(p, '/mnt') for p in other))
+        self.assertEqual(50, sum(len(s) for s in shards))
+        self.assertEqual(50, len(set.union(*shards)))
+
+    def test_mergePlans_resolvesCollisionsBetweenShards(self):
+        target = os.path.join(self.tmpdir, 'Title.fb2')
+        plans = []
+        for i in range(2):
+            plans.append(os.path.join(self.tmpdir, 'plan%d.jsonl' % i))
+            with open(plans[-1], 'w') as f:
+                f.write(json.dumps({
+                    'old': os.path.join(self.tmpdir, '%d.fb2' % i),
+                    'new': target, 'error': None}) + '\n')
+        merged, collisions, errors = merge_plans(plans, TargetIndex())
+        self.assertEqual(target, merged[plans[0]][0]['new'])
+        self.assertEqual(
+            os.path.join(self.tmpdir, 'Title (1).fb2'),
+            merged[plans[1]][0]['new'])
+        self.assertEqual(1, len(collisions))
+        self.assertEqual([], errors)
+
+    def test_mergePlans_suffixesFromBaseName(self):
+        books = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, 'book%d' % i)
+            os.mkdir(path)
+            books.append(make_fb2(os.path.join(path, '%d.fb2' % i)))
+        out_dir = os.path.join(self.tmpdir, 'out')
+        plans = []
+        for shard in ([books[0]], [books[1], books[2]]):
+            plans.append(os.path.join(self.tmpdir, 'plan%d.jsonl' % len(plans)))
+            with open(plans[-1], 'w') as f:
+                for item in rename_batch(
+                        shard, '%title%', out_dir, a_dry_run=True):
+                    f.write(json.dumps(item.to_dict()) + '\n')
+        merged, collisions, errors = merge_plans(plans, TargetIndex())
+        self.assertEqual(
+            [os.path.join(out_dir, n) for n in (
+                'Title.fb2', 'Title (1).fb2', 'Title (2).fb2')],
+            [r['new'] for p in plans for r in merged[p]])
+        self.assertEqual(2, len(collisions))
+
+
+class ParseLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        self.quarantine = os.path.join(self.tmpdir, 'quarantine')
+        os.mkdir(self.out_dir)
+        self.limits = Book_fb2.limits
+
+    def tearDown(self):
+        Book_fb2.limits = self.limits
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_open_throws_whenHeaderIsTooLarge(self):
+        path = make_fb2(
+            os.path.join(self.tmpdir, 'book.fb2'), a_title='x' * 10000)
+        Book_fb2.limits = ParseLimits(a_max_header=4096)
+        self.assertRaises(LimitError, Book_fb2().open, path)
+        Book_fb2.limits = ParseLimits(a_max_header=20000)
+        Book_fb2().open(path)
+
+    def test_open_readsSmallHeader_ofLargeBook(self):
+        path = make_fb2(
+            os.path.join(self.tmpdir, 'book.fb2'), a_tail='<p/>' * 25000)
+        Book_fb2.limits = ParseLimits(a_max_header=4096)
+        book = Book_fb2()
+        book.open(path)
+        self.assertEqual(u'Title', book.get_value('title'))
+        Book_fb2.limits = ParseLimits(a_max_bytes=4096)
+        self.assertRaises(LimitError, Book_fb2(False).open, path)
+
+    def test_open_doesNotExpandEntities(self):
+        path = os.path.join(self.tmpdir, 'bomb.fb2')
+        with open(path, 'wb') as f:
+            f.write(
+                '<?xml version="1.0"?><!DOCTYPE l [<!ENTITY a "aaaaaaaaaa">'
+                '<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+                '<FictionBook><description><title-info><book-title>&b;'
+                '</book-title></title-info></description></FictionBook>')
+        book = Book_fb2()
+        book.open(path)
+        self.assertFalse(book.meta.title)
+
+    def test_open_throwsLimitError_whenEntitiesAmplify(self):
+        path = os.path.join(self.tmpdir, 'bomb.fb2')
+        entities = ''.join(
+            '<!ENTITY a%d "%s">' % (i, '&a%d;' % (i - 1) * 10)
+            for i in range(1, 8))
+        with open(path, 'wb') as f:
+            f.write(
+                '<?xml version="1.0"?><!DOCTYPE l [<!ENTITY a0 "' +
+                'x' * 50 + '">' + entities + ']><FictionBook><description>'
+                '<title-info><book-title>&a7;</book-title></title-info>'
+                '</description></FictionBook>')
+        for header_only in (True, False):
+            try:
+                Book_fb2(header_only).open(path)
+                self.fail('LimitError expected')
+            except LimitError as e:
+                self.assertTrue('amplification' in str(e))
+
+    def test_getValue_reportsParserError_whenRecoveredBookIsEmpty(self):
+        path = os.path.join(self.tmpdir, 'cut.fb2')
+        with open(path, 'wb') as f:
+            f.write('<?xml version="1.0"?><FictionBook><description>'
+                    '<title-info><book-ti')
+        book = Book_fb2()
+        book.open(path)
+        try:
+            book.get_value('title')
+            self.fail('Exception expected')
+        except Exception as e:
+            self.assertTrue(str(e).startswith("There's no title; "))
+            self.assertTrue('book-ti' in str(e))
+
+    def test_renameBatch_quarantinesBooksOverLimit(self):
+        small = make_fb2(os.path.join(self.tmpdir, 'small.fb2'))
+        large = make_fb2(
+            os.path.join(self.tmpdir, 'large.fb2'), a_title='Large',
+            a_tail='<binary>' + 'x' * 10000 + '</binary>')
+        Book_fb2.limits = ParseLimits(a_max_bytes=4096)
+        items = list(rename_batch(
+            [large, small], '%title%', self.out_dir, a_header_only=False,
+            a_quarantine=self.quarantine))
+        self.assertTrue(isinstance(items[0].error, LimitError))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.quarantine, 'large.fb2')))
+        self.assertEqual(None, items[1].error)
+        self.assertTrue(os.path.exists(items[1].target))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.files = []
+        for i in range(10):
+            for d in ('a', 'b'):
+                path = os.path.join(self.tmpdir, d, '%02d.fb2' % i)
+                Common.ensure_path_exists(os.path.dirname(path))
+                self.files.append(make_fb2(path))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_iter_ordersByInode_andReportsSeeks(self):
+        stats = RunStats()
+        files = list(reversed(self.files))
+        ordered = list(Scheduler('inode', 0).iter(files, stats))
+        self.assertEqual(
+            sorted(files, key=lambda f: os.stat(f).st_ino), ordered)
+        schedule = stats.get_summary()['schedule']
+        self.assertEqual(20, schedule['files'])
+        self.assertTrue(schedule['seeks_after'] <= schedule['seeks_before'])
+        self.assertTrue(any('order inode' in l for l in stats.format_summary()))
+
+    def test_iter_timesSchedulingApartFromDiscovery(self):
+        stats = RunStats()
+        scheduler = Scheduler('inode', 0)
+        scheduler.schedule = lambda a_files: time.sleep(0.05) or a_files
+        files = stats.timed('discovery', self.files)
+        self.assertEqual(self.files, list(scheduler.iter(files, stats)))
+        self.assertTrue(stats.totals['schedule'] >= 0.05)
+        self.assertTrue(stats.totals['discovery'] < 0.05)
+
+    def test_iter_keepsEveryFile_inEachOrder(self):
+        for order in Scheduler.orders:
+            ordered = list(Scheduler(order, 7).iter(self.files))
+            self.assertEqual(sorted(self.files), sorted(ordered))
+
+    def test_countSeeks_ignoresNearbyExtents(self):
+        scheduler = Scheduler('extent')
+        positions = [
+            (1, 0, 0, 4096), (1, 0, 8192, 12288), (1, 0, 1 << 30, 1 << 31),
+            (1, 1, 10, 11)]
+        self.assertEqual(2, scheduler.count_seeks(positions))
+
+
+class FileOpsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+        self.src = make_fb2(os.path.join(self.tmpdir, 'src.fb2'))
+        self.dst = os.path.join(self.tmpdir, 'dst.fb2')
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def read(self, a_path):
+        with open(a_path, 'rb') as f:
+            return f.read()
+
+    def test_link_createsHardlink(self):
+        FileOps.apply('link', self.src, self.dst)
+        self.assertEqual(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+
+    def test_copy_keepsSourceAndContent(self):
+        FileOps.apply('copy', self.src, self.dst)
+        self.assertEqual(self.read(self.src), self.read(self.dst))
+        self.assertEqual(
+            int(os.stat(self.src).st_mtime), int(os.stat(self.dst).st_mtime))
+
+    def test_sendfile_copiesData(self):
+        with open(self.src, 'rb') as src:
+            with open(self.dst, 'wb') as dst:
+                size = os.fstat(src.fileno()).st_size
+                sent = FileOps.sendfile(src.fileno(), dst.fileno(), 0, size)
+        self.assertEqual(size, sent)
+        self.assertEqual(self.read(self.src), self.read(self.dst))
+
+    def test_move_copiesAndRemoves_whenRenameCrossesDevices(self):
+        content = self.read(self.src)
+        saved_rename = os.rename
+
+        def rename(a_src, a_dst):
+            if a_src == self.src:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            saved_rename(a_src, a_dst)
+        os.rename = rename
+        try:
+            FileOps.apply('move', self.src, self.dst)
+        finally:
+            os.rename = saved_rename
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEqual(content, self.read(self.dst))
+        self.assertEqual(['dst.fb2'], os.listdir(self.tmpdir))
+
+    def test_copy_keepsBook_whenTargetIsSameFile(self):
+        content = self.read(self.src)
+        alias = os.path.join(self.tmpdir, 'alias')
+        os.symlink(self.tmpdir, alias)
+        FileOps.apply('copy', self.src, os.path.join(alias, 'src.fb2'))
+        self.assertEqual(content, self.read(self.src))
+        self.assertTrue(TargetIndex().is_same(
+            self.src, os.path.join(alias, 'src.fb2')))
+
+
+class RunStatsTest(unittest.TestCase):
+
+    def get_item(self, a_fname, a_seconds):
+        item = RenameItem(a_fname)
+        item.parse_time = a_seconds
+        item.size = 1000
+        return item
+
+    def test_getSummary_reportsPercentilesAndSlowest(self):
+        stats = RunStats(a_slowest=2)
+        for i in range(100):
+            stats.add(self.get_item('f%d' % i, (i + 1) / 1000.0))
+        summary = stats.get_summary()
+        self.assertEqual(100, summary['files'])
+        self.assertEqual(100000, summary['bytes'])
+        self.assertAlmostEqual(0.050, summary['latency']['p50'], 2)
+        self.assertAlmostEqual(0.095, summary['latency']['p95'], 2)
+        self.assertEqual(
+            ['f99', 'f98'], [e['file'] for e in summary['slowest']])
+
+    def test_timed_yieldsAllItems(self):
+        stats = RunStats()
+        self.assertEqual([1, 2, 3], list(stats.timed('discovery', [1, 2, 3])))
+        self.assertTrue(stats.totals['discovery'] >= 0.0)
+
+    def test_add_writesProgress(self):
+        class Stream(object):
+
+            def __init__(self):
+                self.lines = []
+
+            def write(self, a_line):
+                self.lines.append(a_line)
+        stream = Stream()
+        stats = RunStats(a_progress=1e-9, a_stream=stream)
+        stats.last_progress -= 1
+        stats.add(self.get_item('f', 0.001))
+        self.assertTrue(stream.lines[0].startswith('1 files'))
+
+
+class BenchCorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix=os.path.basename(__file__))
+
+    def tearDown(self):
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def test_generate_isDeterministic(self):
+        from bench_fb2rename import Corpus
+        self.assertEqual(Corpus(3).generate(7), Corpus(3).generate(7))
+        self.assertNotEqual(Corpus(3).generate(7), Corpus(4).generate(7))
+
+    def test_write_createsParsableBooksInAllEncodings(self):
+        from bench_fb2rename import Corpus
+        corpus = Corpus(a_max_body_kb=1, a_max_binary_kb=1)
+        corpus.write(self.tmpdir, 4)
+        book = Book_fb2()
+        for i in range(4):
+            book.open(corpus.get_path(self.tmpdir, i))
+            self.assertTrue(book.get_value('title').endswith(' %d' % i))
+        self.assertTrue(book.meta.authors)
+
 
 if __name__ == '__main__':
     unittest.main()